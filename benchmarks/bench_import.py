@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+import time benchmark
+
+imports each module in a fresh interpreter, reports the median import time
+and fails if it pulled in a driver / sdk that should only load on first use.
+
+    python benchmarks/bench_import.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# ----
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# driver / sdk modules that must not be loaded by a plain import
+LAZY_MODULES = ('boto3', 'botocore', 'pymssql', 'MySQLdb', 'psycopg2',
+                'elasticsearch', 'requests_aws4auth', 'dynamodb_json',
+                'aiohttp', 'numpy')
+
+MODULES = ('risk_utils.data.data',
+           'risk_utils.blacklist.blacklist',
+           'risk_utils.cendeu.cendeu',
+           'risk_utils.nosis.nosis',
+           'risk_utils.enrichment.enrichment')
+
+SCRIPT = '''
+import json, sys, time
+t0 = time.perf_counter()
+import %(module)s
+t1 = time.perf_counter()
+print(json.dumps({
+    'secs': t1 - t0,
+    'loaded': [name for name in %(lazy)r if name in sys.modules]
+}))
+'''
+
+# ----
+
+def measure(module, runs):
+
+    times, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT % { 'module': module, 'lazy': LAZY_MODULES }],
+            cwd=ROOT)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        times.append(result['secs'])
+        loaded.update(result['loaded'])
+
+    return statistics.median(times), sorted(loaded)
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        try:
+            secs, loaded = measure(module, args.runs)
+        except subprocess.CalledProcessError:
+            print('%-36s import failed' % module)
+            failed = True
+            continue
+
+        print('%-36s %8.1f ms  %s' % (module, secs * 1000,
+                                      'eager: %s' % ', '.join(loaded) if loaded else 'ok'))
+        failed = failed or bool(loaded)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+audit module
+
+'record_evaluation(event)' hands an evaluation event to a background
+pipeline that writes it to dynamodb and elasticsearch in batches, so the
+audit writes are off the decision path.
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from ..client.cache import private_dir
+from ..data.dynamodb import BatchWriter, to_item
+from ..data.elastic import BulkIndexer
+
+# ----
+
+AUDIT_DDB_TABLE = os.environ.get('API_DDB_AUDIT_TBL', '')
+AUDIT_ES_INDEX = os.environ.get('API_ES_AUDIT_INDEX', '')
+AUDIT_MAX_QUEUE = int(os.environ.get('AUDIT_MAX_QUEUE', 10000))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1))
+# secs the exit handler waits for the queued events
+AUDIT_CLOSE_TIMEOUT = float(os.environ.get('AUDIT_CLOSE_TIMEOUT', 10))
+AUDIT_SPILL_PATH = os.environ.get('AUDIT_SPILL_PATH')
+
+DYNAMODB = 'dynamodb'
+ELASTICSEARCH = 'elasticsearch'
+
+# dynamodb errors replaying won't fix
+_DYNAMODB_PERMANENT_ERRORS = ('ValidationException', 'ResourceNotFoundException',
+                              'AccessDeniedException')
+
+_STOP = object()
+
+@contextmanager
+def _file_lock(path, blocking=True):
+    """
+    exclusive flock on 'path' (created 0600), held by one process of the
+    host at a time. yields False when not 'blocking' and another process
+    holds it.
+    """
+    import fcntl
+
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        # closing the file releases the lock
+        os.close(fd)
+
+# ----
+
+class EvaluationSink(object):
+    """
+    @param table_name: dynamodb table, '' to skip dynamodb
+    @param index_name: elasticsearch index, '' to skip elasticsearch
+    @param max_queue: events waiting for the dispatcher before 'record'
+                      pushes back
+    @param put_timeout: secs 'record' waits on a full queue before it
+                        spills the event to disk instead
+    @param flush_size: documents per '_bulk' request (dynamodb batches are
+                       always 25)
+    @param flush_interval: max secs an event waits to be sent
+    @param spill_path: jsonl file for the events a backend didn't take
+                       (full or down), sent again by 'replay_spill'.
+                       defaults to $AUDIT_SPILL_PATH or 'audit_spill.jsonl'
+                       in 'client.cache.private_dir()'
+    @param replay_interval: secs between automatic 'replay_spill' runs
+    @param dynamodb_writer / es_indexer: 'BatchWriter' / 'BulkIndexer' to
+                       use instead of the default ones (their on_error is
+                       replaced)
+
+    the workers of a host can share the spill file: appends are serialized
+    with a file lock and only one worker replays it at a time.
+    """
+
+    def __init__(self, table_name=AUDIT_DDB_TABLE, index_name=AUDIT_ES_INDEX,
+                 max_queue=AUDIT_MAX_QUEUE,
+                 put_timeout=0.01,
+                 flush_size=500,
+                 flush_interval=AUDIT_FLUSH_INTERVAL,
+                 spill_path=None,
+                 replay_interval=300,
+                 dynamodb_writer=None,
+                 es_indexer=None):
+        self.table_name = table_name
+        self.index_name = index_name
+        self.put_timeout = put_timeout
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spill_path = (spill_path or AUDIT_SPILL_PATH
+                           or os.path.join(private_dir(), 'audit_spill.jsonl'))
+        self.replay_interval = replay_interval
+
+        self.recorded = 0
+        self.spilled = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._dynamodb = dynamodb_writer
+        self._es = es_indexer
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    # ---- backends
+
+    def _backends(self):
+
+        if self._dynamodb is None and self.table_name:
+            from ..data.data import dynamodb_handler
+            self._dynamodb = dynamodb_handler().batch_writer(
+                self.table_name, flush_interval=self.flush_interval)
+        if self._es is None and self.index_name:
+            from ..data.data import elasticsearch_handler
+            self._es = elasticsearch_handler().bulk_indexer(
+                self.index_name, max_docs=self.flush_size, flush_interval=self.flush_interval)
+
+        if self._dynamodb is not None:
+            self._dynamodb.on_error = self._dynamodb_failed
+        if self._es is not None:
+            self._es.on_error = self._es_failed
+
+    def _dispatch(self, event):
+
+        if self._dynamodb is not None:
+            try:
+                self._dynamodb.put(event, timeout=0)
+            except BatchWriter.Error:
+                # full: dynamodb is slow or down
+                self._spill_dynamodb(event)
+            except TypeError as err:
+                print('audit error: event not stored in dynamodb - %s' % err)
+
+        if self._es is not None:
+            try:
+                self._es.put(event, timeout=0)
+            except BulkIndexer.Error:
+                self._spill_es(event)
+            except TypeError as err:
+                print('audit error: event not indexed - %s' % err)
+
+    def _run(self):
+
+        # spilled events of a previous run go first
+        next_replay = time.time()
+        while True:
+            try:
+                event = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                event = None
+
+            if event is _STOP:
+                self._queue.task_done()
+                return
+
+            if event is not None:
+                try:
+                    self._dispatch(event)
+                except Exception as err:
+                    print('audit error: %s' % err)
+                finally:
+                    self._queue.task_done()
+
+            if self.replay_interval and time.time() >= next_replay:
+                next_replay = time.time() + self.replay_interval
+                try:
+                    self.replay_spill()
+                except Exception as err:
+                    print('audit replay error: %s' % err)
+
+    def start(self):
+        """
+        creates the backends and starts the dispatcher (daemon thread), done
+        by the first 'record'.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self
+
+            self._backends()
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name='audit-sink')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    # ---- producer
+
+    def record(self, event):
+        """
+        queues 'event' (a dict) and returns at once. when the queue is full
+        for 'put_timeout' secs the event goes to the spill file instead.
+        @return: True if queued, False if spilled
+        """
+        if self._thread is None:
+            self.start()
+
+        if not self._closed:
+            try:
+                self._queue.put(event, timeout=self.put_timeout)
+                self.recorded += 1
+                return True
+            except queue.Full:
+                pass
+
+        self._spill_dynamodb(event)
+        self._spill_es(event)
+        return False
+
+    # ---- spill
+
+    def _spill(self, backend, payloads):
+
+        lines = ''.join(json.dumps({ 'backend': backend, 'payload': payload }, default=str) + '\n'
+                        for payload in payloads)
+        with self._spill_lock, _file_lock(self.spill_path + '.lock'):
+            fd = os.open(self.spill_path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+            with os.fdopen(fd, 'a', encoding='utf-8') as spill:
+                spill.write(lines)
+            self.spilled += len(payloads)
+
+    def _spill_dynamodb(self, event):
+
+        if self._dynamodb is not None:
+            self._spill(DYNAMODB, [to_item(event)])
+
+    def _spill_es(self, event):
+
+        if self._es is not None:
+            serializer = self._es.client.transport.serializer
+            self._spill(ELASTICSEARCH, [json.loads(serializer.dumps(event))])
+
+    def _dynamodb_failed(self, items, error):
+
+        code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+        if code in _DYNAMODB_PERMANENT_ERRORS:
+            print('audit error: %s items not stored in dynamodb - %s' % (len(items), error))
+            return
+        self._spill(DYNAMODB, items)
+
+    def _es_failed(self, errors):
+
+        retryable = [error['doc'] for error in errors if error['retryable']]
+        if len(retryable) < len(errors):
+            print('audit error: %s events not indexed - %s'
+                  % (len(errors) - len(retryable), errors[0]['error']))
+        if retryable:
+            serializer = self._es.client.transport.serializer
+            self._spill(ELASTICSEARCH, [json.loads(serializer.dumps(doc)) for doc in retryable])
+
+    def replay_spill(self):
+        """
+        sends the spilled events again. once a backend refuses one, the rest
+        of its events are spilled again. does nothing while another worker
+        replays.
+        @return: number of events replayed
+        """
+        with _file_lock(self.spill_path + '.replay.lock', blocking=False) as locked:
+            if not locked:
+                return 0
+            return self._replay()
+
+    def _replay(self):
+
+        replay_path = self.spill_path + '.replay'
+        with self._spill_lock, _file_lock(self.spill_path + '.lock'):
+            # a replay file left by a crash is sent first
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return 0
+                os.replace(self.spill_path, replay_path)
+
+        # a backend that is still full or down takes no more lines: the rest
+        # of its events go back to the spill file at once, instead of
+        # waiting 'flush_interval' secs each
+        replayed = 0
+        backends = { DYNAMODB: self._dynamodb, ELASTICSEARCH: self._es }
+        failed = {} # backend -> payloads left
+        with open(replay_path, encoding='utf-8') as spill:
+            for line in spill:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut by a crash
+                    continue
+
+                backend, payload = record['backend'], record['payload']
+                if backends.get(backend) is None:
+                    continue
+                if backend in failed:
+                    failed[backend].append(payload)
+                    continue
+
+                try:
+                    if backend == DYNAMODB:
+                        self._dynamodb.put_item(payload, timeout=self.flush_interval)
+                    else:
+                        self._es.put(payload, timeout=self.flush_interval)
+                    replayed += 1
+                except (BatchWriter.Error, BulkIndexer.Error):
+                    failed[backend] = [payload]
+
+        for backend, payloads in failed.items():
+            self._spill(backend, payloads)
+
+        os.unlink(replay_path)
+        return replayed
+
+    # ---- shutdown
+
+    def flush(self):
+        """
+        sends every queued event and waits for the backends.
+        """
+        self._queue.join()
+        for backend in (self._dynamodb, self._es):
+            if backend is not None:
+                backend.flush()
+
+    def _spill_queued(self):
+        """
+        moves the events still queued to the spill file.
+        @return: True if the stop marker was among them
+        """
+        stop = False
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                return stop
+            try:
+                if event is _STOP:
+                    stop = True
+                else:
+                    self._spill_dynamodb(event)
+                    self._spill_es(event)
+            finally:
+                self._queue.task_done()
+
+    def close(self, timeout=None):
+        """
+        stops taking events (later ones are spilled), sends the queued ones
+        and closes the backends, within 'timeout' secs: the events the
+        dispatcher did not get to by then are spilled.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.time(), 0)
+
+        with self._lock:
+            if self._closed or self._thread is None:
+                self._closed = True
+                return
+            self._closed = True
+
+        try:
+            self._queue.put(_STOP, timeout=remaining())
+        except queue.Full:
+            # the dispatcher is stuck: spill what it would send, then stop it
+            self._spill_queued()
+            self._queue.put_nowait(_STOP)
+
+        self._thread.join(remaining())
+        if self._thread.is_alive() and self._spill_queued():
+            # the dispatcher stops when it gets back to the queue
+            self._queue.put_nowait(_STOP)
+
+        for backend in (self._dynamodb, self._es):
+            if backend is not None:
+                backend.close(remaining())
+
+# ----
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_sink():
+    """
+    process-wide sink used by 'record_evaluation', flushed at exit for at
+    most $AUDIT_CLOSE_TIMEOUT secs.
+    """
+    global _sink
+
+    with _sink_lock:
+        if _sink is None:
+            _sink = EvaluationSink()
+            atexit.register(_sink.close, AUDIT_CLOSE_TIMEOUT)
+    return _sink
+
+def record_evaluation(event):
+    """
+    queues an evaluation event for dynamodb (API_DDB_AUDIT_TBL) and
+    elasticsearch (API_ES_AUDIT_INDEX) and returns at once.
+    @return: True if queued, False if spilled to disk
+    """
+    return get_sink().record(event)
@@ -3,13 +3,17 @@
 """
 blacklist module
 """
+import asyncio
 import json
 import os
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from dotenv import load_dotenv, find_dotenv 
-# https://github.com/theskumar/python-dotenv#installation
+from ..client.session import get_session, get_async_session, \
+                             DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE
+from ..client.batch import run_many, DEFAULT_CONCURRENCY
+from ..client.singleflight import SingleFlight
+from ..client.env import load_env
 
 from retrying import retry
 # https://pypi.org/project/retrying/
@@ -18,8 +22,7 @@ from time import sleep
 
 # ----
 
-dotenv_path = find_dotenv() 
-load_dotenv(dotenv_path)
+load_env()
 
 # ----
 
@@ -28,10 +31,78 @@ class Blacklist(object):
     API_BLACKLIST_TOKEN = os.environ.get('API_BLACKLIST_TOKEN')
     API_BLACKLIST_URL = os.environ.get('API_BLACKLIST_URL')
 
+    # in-flight lookups, shared by every instance in the process
+    _flight = SingleFlight()
+
     class Error(Exception):
         pass
 
-    def is_in_blacklist(self, lead, verbose=False):
+    def __init__(self,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 keep_alive=True,
+                 index=None):
+        # pooled keep-alive session, shared by every instance in the process
+        self.session_options = {
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+            'keep_alive': keep_alive
+        }
+        # optional local 'index.BlacklistIndex', answers negatives without the api
+        self.index = index
+
+    @property
+    def session(self):
+        return get_session('blacklist', **self.session_options)
+
+    @property
+    def async_session(self):
+        return get_async_session('blacklist', **self.session_options)
+
+    def _connection_error(self, err, as_dict):
+
+        if as_dict:
+            error_message = {
+                                'error_code': 0,
+                                'error_message': err
+                            }
+        else:
+            error_message = 'CONNECTION_ERROR - %s' % err
+
+        return self.Error(error_message)
+
+    def _send(self, method, url, error_as_dict=True):
+
+        # send request
+        try:
+            t0 = datetime.now()
+            response = self.session.request(method, url)
+            t1 = datetime.now()
+        except requests.ConnectionError as err:
+            raise self._connection_error(err, error_as_dict)
+
+        return response.status_code, response.text, t1-t0
+
+    async def _send_async(self, method, url, error_as_dict=True):
+        import aiohttp
+
+        # send request
+        try:
+            t0 = datetime.now()
+            async with self.async_session.request(method, url) as response:
+                status_code = response.status
+                text = await response.text()
+            t1 = datetime.now()
+        except aiohttp.ClientConnectionError as err:
+            raise self._connection_error(err, error_as_dict)
+
+        return status_code, text, t1-t0
+
+    # ---- is_in_blacklist
+
+    def _is_in_blacklist_url(self, lead):
 
         # query string params
         qs_params = (
@@ -44,68 +115,116 @@ class Blacklist(object):
                         lead.get('cbu', '')
                     )
         # url formation
-        url = ('%s/api/blacklist?api_token=%s&'
+        return ('%s/api/blacklist?api_token=%s&'
                                 'unique_identifier=%s&'
                                 'phone_number=%s&'
                                 'area=%s&'
                                 'email=%s&'
                                 'cbu=%s') % (qs_params)
-        # send request
-        try:
-            t0 = datetime.now()
-            response = requests.get(url)
-            t1 = datetime.now()
-        except requests.ConnectionError as err:
-            error_message = 'CONNECTION_ERROR - %s' % err
-            raise self.Error(error_message)
-        
+
+    def _fetch_is_in_blacklist(self, url, verbose):
+
+        status_code, text, response_time = self._send('GET', url, error_as_dict=False)
+        return self._is_in_blacklist_response(status_code, text, response_time, verbose)
+
+    async def _fetch_is_in_blacklist_async(self, url, verbose):
+
+        status_code, text, response_time = await self._send_async('GET', url, error_as_dict=False)
+        return self._is_in_blacklist_response(status_code, text, response_time, verbose)
+
+    def _not_in_index(self, lead, verbose):
+
+        if self.index is None or self.index.might_be_blacklisted(lead):
+            return None
+
+        if not verbose:
+            return False
+        return  {
+                    'data': { 'is_in_blacklist': False },
+                    'response_time': timedelta(0)
+                }
+
+    def is_in_blacklist(self, lead, verbose=False):
+
+        result = self._not_in_index(lead, verbose)
+        if result is not None:
+            return result
+
+        # concurrent calls for the same lead share one request
+        url = self._is_in_blacklist_url(lead)
+        return self._flight.do((url, verbose), lambda: self._fetch_is_in_blacklist(url, verbose))
+
+    async def is_in_blacklist_async(self, lead, verbose=False):
+
+        result = self._not_in_index(lead, verbose)
+        if result is not None:
+            return result
+
+        url = self._is_in_blacklist_url(lead)
+        return await self._flight.do_async((url, verbose),
+                                           lambda: self._fetch_is_in_blacklist_async(url, verbose))
+
+    def is_in_blacklist_many(self, leads, concurrency=DEFAULT_CONCURRENCY, verbose=False):
+        """
+        runs 'is_in_blacklist' over an iterable of leads with at most
+        'concurrency' requests in flight and yields, as each one finishes,
+        { 'index', 'result', 'error' } (see 'client.batch.run_many').
+
+        keep 'pool_maxsize' >= 'concurrency' so every request reuses a
+        pooled connection.
+        """
+        return run_many(lambda lead: self.is_in_blacklist(lead, verbose=verbose),
+                        leads, concurrency)
+
+    def _is_in_blacklist_response(self, status_code, text, response_time, verbose):
+
         # handle ok response
-        if response.status_code == 200:
+        if status_code == 200:
 
             is_mutual_customer = False
-            # TODO: pasar a else en verbose False case 
+            # TODO: pasar a else en verbose False case
 
             if not verbose:
                 return True
             else:
-                
-                res = json.loads(response.text)
+
+                res = json.loads(text)
                 # TODO: res to raw_data
-                
+
                 if res.get('reason', 'missing') == 'SOCIO_MUTUAL':
                     is_mutual_customer = True
-                
-                
-                return  {   
+
+
+                return  {
                             'data': {
                                         'is_in_blacklist': True,
                                         'is_mutual_customer': is_mutual_customer, # FIXME: esto no va aqui
                                         'blacklisted_reason': res.get('reason', 'missing'),
                                         'blacklisted_field': res.get('field', None),
                                     },
-                            'response_time': t1-t0
-                        } 
-                # TODO: data and raw_data 
-        
+                            'response_time': response_time
+                        }
+                # TODO: data and raw_data
+
         # handle not ok response
-        elif response.status_code == 204:
-           
+        elif status_code == 204:
+
             if not verbose:
                 return False
             else:
                 return  {
                             'data': { 'is_in_blacklist': False },
-                            'response_time': t1-t0
+                            'response_time': response_time
                         }
-        
+
         # handle error response
         else:
-            error_message = '%s - %s' % (response.status_code, response.text) 
+            error_message = '%s - %s' % (status_code, text)
             raise self.Error(error_message)
 
-    # retry
-    @retry()
-    def put_in_blacklist(self, lead, reason):
+    # ---- put_in_blacklist
+
+    def _put_in_blacklist_url(self, lead, reason):
 
         # query string params
         qs_params = (
@@ -120,7 +239,7 @@ class Blacklist(object):
                         lead.get('cbu', ''),
                     )
         # url formation
-        url = ('%s/api/blacklist?api_token=%s&'
+        return ('%s/api/blacklist?api_token=%s&'
                                 'creator=%s&'
                                 'reason=%s&'
                                 'unique_identifier=%s&'
@@ -128,42 +247,80 @@ class Blacklist(object):
                                 'phone_number=%s&'
                                 'email=%s&'
                                 'cbu=%s') % (qs_params)
-        # send request
-        try:
-            t0 = datetime.now()
-            response = requests.post(url)
-            t1 = datetime.now()
-        except requests.ConnectionError as err:
-            error_message = { 
-                                'error_code': 0,
-                                'error_message': err
-                            }
-            raise self.Error(error_message)
 
-        # handle ok response
-        if response.status_code == 201:
-            return  { 
-                        'created': True,
-                        'messsage': json.loads(response.text),
-                        'response_time': t1-t0
-                    }
-        
-        if response.status_code == 204:
+    # retry (blocks until created, see 'writer.BlacklistWriter' for a non-blocking put)
+    @retry()
+    def put_in_blacklist(self, lead, reason):
+
+        status_code, text, response_time = self._send('POST', self._put_in_blacklist_url(lead, reason))
+
+        if status_code == 204:
             print('retrying in 10 secs')
             sleep(10)
             raise self.Error
 
+        return self._put_in_blacklist_response(lead, status_code, text, response_time)
+
+    async def put_in_blacklist_async(self, lead, reason, max_attempts=10, backoff=1, max_backoff=60):
+        """
+        retries a 204 (not created yet, 10 secs between attempts), 429 / 5xx
+        and connection errors (exponential backoff from 'backoff' up to
+        'max_backoff' secs), at most 'max_attempts' times, without blocking
+        the event loop. any other error (bad token, validation) is raised at
+        once. see 'writer.BlacklistWriter' for a durable, non-blocking put.
+        @raise: Blacklist.Error
+        """
+        url = self._put_in_blacklist_url(lead, reason)
+
+        for attempt in range(max_attempts):
+            last_attempt = attempt + 1 >= max_attempts
+            try:
+                status_code, text, response_time = await self._send_async('POST', url)
+            except self.Error:
+                # connection error
+                if last_attempt:
+                    raise
+                await asyncio.sleep(min(backoff * 2 ** attempt, max_backoff))
+                continue
+
+            if status_code == 204 and not last_attempt:
+                await asyncio.sleep(10)
+                continue
+            if (status_code == 429 or status_code >= 500) and not last_attempt:
+                await asyncio.sleep(min(backoff * 2 ** attempt, max_backoff))
+                continue
+            if status_code == 204:
+                error_message = {
+                                    'error_code': 204,
+                                    'error_message': 'not created after %s attempts' % max_attempts
+                                }
+                raise self.Error(error_message)
+            return self._put_in_blacklist_response(lead, status_code, text, response_time)
+
+    def _put_in_blacklist_response(self, lead, status_code, text, response_time):
+
+        # handle ok response
+        if status_code == 201:
+            if self.index is not None:
+                self.index.add(lead)
+            return  {
+                        'created': True,
+                        'messsage': json.loads(text),
+                        'response_time': response_time
+                    }
+
         # handle error response
         else:
-            error_message = { 
-                                'error_code': response.status_code,
-                                'error_message': response.text
+            error_message = {
+                                'error_code': status_code,
+                                'error_message': text
                             }
             raise self.Error(error_message)
 
+    # ---- remove_from_blacklist
+
+    def _remove_from_blacklist_url(self, lead):
 
-    def remove_from_blacklist(self, lead):
-        
         # query string params
         qs_params = (
                         self.API_BLACKLIST_URL,
@@ -174,34 +331,35 @@ class Blacklist(object):
                         lead.get('cbu', '')
                     )
         # url formation
-        url = ('%s/api/blacklist?api_token=%s&'
+        return ('%s/api/blacklist?api_token=%s&'
                                 'unique_identifier=%s&'
                                 'phone_number=%s&'
                                 'email=%s&'
                                 'cbu=%s') % (qs_params)
-        # send request
-        try:
-            t0 = datetime.now()
-            response = requests.delete(url)
-            t1 = datetime.now()
-        except requests.ConnectionError as err:
-            error_message = { 
-                                'error_code': 0,
-                                'error_message': err
-                            }
-            raise self.Error(error_message)
+
+    def remove_from_blacklist(self, lead):
+
+        status_code, text, response_time = self._send('DELETE', self._remove_from_blacklist_url(lead))
+        return self._remove_from_blacklist_response(status_code, text, response_time)
+
+    async def remove_from_blacklist_async(self, lead):
+
+        status_code, text, response_time = await self._send_async('DELETE', self._remove_from_blacklist_url(lead))
+        return self._remove_from_blacklist_response(status_code, text, response_time)
+
+    def _remove_from_blacklist_response(self, status_code, text, response_time):
 
         # handle ok response
-        if response.status_code == 200:
-            return { 
+        if status_code == 200:
+            return {
                         'removed': True,
-                        'messsage': json.loads(response.text),
-                        'response_time': t1-t0
+                        'messsage': json.loads(text),
+                        'response_time': response_time
                     }
         # handle error response
         else:
-            error_message = { 
-                                'error_code': response.status_code,
-                                'error_message': response.text
+            error_message = {
+                                'error_code': status_code,
+                                'error_message': text
                             }
             raise self.Error(error_message)
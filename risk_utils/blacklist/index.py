@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+blacklist index module
+
+local copy of the blacklisted cuits, phones (area + number), emails and cbus
+built from MYSQL_CONFIG['Otras']['BLACKLIST']. it answers "not blacklisted"
+without going to the api; possible hits are confirmed by the api, which
+also gives the 'reason' and 'field'.
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+# ----
+
+class BloomFilter(object):
+    """
+    bit array bloom filter, sized for 'capacity' items at 'error_rate'
+    false positives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+
+        # double hashing: h1 + i * h2
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+# ----
+
+_NON_DIGITS = re.compile(r'\D')
+
+def _digits(value):
+    if value is None:
+        return ''
+    return _NON_DIGITS.sub('', str(value))
+
+def _lead_keys(unique_identifier=None, area=None, phone_number=None, email=None, cbu=None):
+    """
+    normalized index keys of a lead / blacklist row, so both sides give the
+    same key whatever the format:
+
+    - cuit and cbu: digits only ('20-12345678-9' -> '20123456789')
+    - phone: digits of area + number, area without its leading 0 and
+      number without the mobile 15 when both make 12 digits
+      ('011', '15 4444-5555' -> '1144445555')
+    - email: stripped and lowercased
+    """
+    keys = []
+
+    unique_identifier = _digits(unique_identifier)
+    if unique_identifier:
+        keys.append('unique_identifier:%s' % unique_identifier)
+
+    phone_number = _digits(phone_number)
+    if phone_number:
+        area = _digits(area).lstrip('0')
+        if len(area) + len(phone_number) == 12 and phone_number.startswith('15'):
+            phone_number = phone_number[2:]
+        keys.append('phone:%s%s' % (area, phone_number))
+
+    email = '' if email is None else str(email).strip()
+    if email:
+        keys.append('email:%s' % email.lower())
+
+    cbu = _digits(cbu)
+    if cbu:
+        keys.append('cbu:%s' % cbu)
+
+    return keys
+
+class BlacklistIndex(object):
+    """
+    bloom filter + exact set of the blacklist, refreshed in increments.
+
+    the blacklist table is expected to have 'unique_identifier', 'area',
+    'phone_number', 'email', 'cbu', 'updated_at' and a soft delete
+    'deleted_at' column. override 'SYNC_QUERY' if the schema differs.
+
+    entries added elsewhere are seen after the next 'refresh', so the
+    refresh interval bounds how stale a negative answer can be. once the
+    last successful sync is older than 'max_staleness' secs (refreshes
+    failing), every lead goes to the api again.
+
+    @param sync_overlap: minutes re-read before the last 'updated_at' on
+                         each refresh, for rows committed late with an
+                         earlier 'updated_at'
+    @param full_build_interval: secs between full rebuilds done by
+                                'refresh', whatever the increments saw
+    @param max_staleness: secs after the last successful sync from which
+                          'might_be_blacklisted' always answers True
+    """
+
+    BLACKLIST_TABLE = os.environ.get('DB_BLACKLIST_TABLE', 'blacklist')
+    SYNC_OVERLAP = int(os.environ.get('BLACKLIST_SYNC_OVERLAP', 10))
+    FULL_BUILD_INTERVAL = int(os.environ.get('BLACKLIST_FULL_BUILD_INTERVAL', 6 * 3600))
+    MAX_STALENESS = int(os.environ.get('BLACKLIST_MAX_STALENESS', 1800))
+
+    SYNC_QUERY = ('SELECT unique_identifier, area, phone_number, email, cbu, '
+                  'updated_at, deleted_at '
+                  'FROM ' + BLACKLIST_TABLE + ' '
+                  'WHERE updated_at >= %s '
+                  'ORDER BY updated_at')
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, capacity=1000000, error_rate=0.001,
+                 server='Otras', database='BLACKLIST',
+                 sync_overlap=SYNC_OVERLAP,
+                 full_build_interval=FULL_BUILD_INTERVAL,
+                 max_staleness=MAX_STALENESS):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.server = server
+        self.database = database
+        self.sync_overlap = sync_overlap
+        self.full_build_interval = full_build_interval
+        self.max_staleness = max_staleness
+
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._keys = set()
+        self._synced_at = None
+        self._built_at = None
+        self._refreshed_at = None # time.time() of the last successful sync
+        self._lock = threading.Lock()
+        self._timer = None
+        self._auto_refresh = False
+
+    @property
+    def synced_at(self):
+        return self._synced_at
+
+    @property
+    def refreshed_at(self):
+        return self._refreshed_at
+
+    def _rows(self, since):
+        from ..data.data import mysql_handler
+
+        try:
+            handler = mysql_handler(self.server, self.database)
+            for row in handler.get_data_by_query(self.SYNC_QUERY, (since,)):
+                yield row
+        except Exception as err:
+            raise self.Error('BLACKLIST_SYNC_ERROR - %s' % err)
+
+    def build(self):
+        """
+        full rebuild. the new filter and set replace the old ones at once,
+        so lookups keep working meanwhile.
+        """
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        keys = set()
+        synced_at = datetime(1970, 1, 1)
+
+        for unique_identifier, area, phone_number, email, cbu, updated_at, deleted_at in self._rows(synced_at):
+            if deleted_at is not None:
+                continue
+            for key in _lead_keys(unique_identifier, area, phone_number, email, cbu):
+                bloom.add(key)
+                keys.add(key)
+            if updated_at is not None and updated_at > synced_at:
+                synced_at = updated_at
+
+        with self._lock:
+            self._bloom, self._keys, self._synced_at = bloom, keys, synced_at
+            self._built_at = self._refreshed_at = time.time()
+
+    def refresh(self):
+        """
+        applies the rows updated since the last sync, minus 'sync_overlap'
+        minutes. builds the index the first time and every
+        'full_build_interval' secs.
+        """
+        if self._synced_at is None or time.time() - self._built_at >= self.full_build_interval:
+            return self.build()
+
+        last_synced_at = synced_at = self._synced_at
+        has_deletions = False
+        since = last_synced_at - timedelta(minutes=self.sync_overlap)
+        for unique_identifier, area, phone_number, email, cbu, updated_at, deleted_at in self._rows(since):
+            if deleted_at is not None:
+                # deletions already seen by a previous refresh are in the
+                # overlap again; late ones are dropped by the next full build
+                # (until then they only send leads to the api)
+                if updated_at is None or updated_at > last_synced_at:
+                    has_deletions = True
+            else:
+                keys = _lead_keys(unique_identifier, area, phone_number, email, cbu)
+                with self._lock:
+                    for key in keys:
+                        self._bloom.add(key)
+                        self._keys.add(key)
+            if updated_at is not None and updated_at > synced_at:
+                synced_at = updated_at
+
+        # another live row may share the deleted values: rebuild instead of
+        # removing keys (deletions are rare)
+        if has_deletions:
+            return self.build()
+
+        self._synced_at = synced_at
+        self._refreshed_at = time.time()
+
+    def start_auto_refresh(self, interval=300):
+        """
+        refreshes the index every 'interval' seconds in a daemon thread.
+        a failed refresh is retried at the next interval.
+        """
+        def run():
+            try:
+                self.refresh()
+            except Exception as err:
+                # a bad row or schema too: never stop the timer chain
+                print('blacklist index refresh failed: %s' % err)
+            if self._auto_refresh:
+                self._timer = threading.Timer(interval, run)
+                self._timer.daemon = True
+                self._timer.start()
+
+        self._auto_refresh = True
+        run()
+
+    def stop_auto_refresh(self):
+
+        self._auto_refresh = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def add(self, lead):
+        """
+        adds a lead right after it was put in the blacklist.
+        """
+        keys = _lead_keys(lead.get('unique_identifier'), lead.get('area'),
+                          lead.get('phone_number'), lead.get('email'), lead.get('cbu'))
+        with self._lock:
+            for key in keys:
+                self._bloom.add(key)
+                self._keys.add(key)
+
+    def might_be_blacklisted(self, lead):
+        """
+        False means the lead is not blacklisted (as of the last sync),
+        True means the api has to confirm it.
+        """
+        # not built yet, or not synced for too long: every lead goes to the api
+        refreshed_at = self._refreshed_at
+        if refreshed_at is None or time.time() - refreshed_at > self.max_staleness:
+            return True
+
+        keys = _lead_keys(lead.get('unique_identifier'), lead.get('area'),
+                          lead.get('phone_number'), lead.get('email'), lead.get('cbu'))
+        bloom, exact = self._bloom, self._keys
+        return any(key in bloom and key in exact for key in keys)
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+blacklist writer module
+
+write-behind queue for 'Blacklist.put_in_blacklist': writes are stored in a
+local sqlite spool and sent by a background thread, so the caller never
+waits for the blacklist api.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .blacklist import Blacklist
+from ..client.batch import run_many
+from ..client.cache import private_dir, create_private
+
+# ----
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+LEAD_FIELDS = ('unique_identifier', 'area', 'phone_number', 'email', 'cbu')
+
+class BlacklistWrite(object):
+    """
+    acknowledgement handle returned by 'BlacklistWriter.put'.
+    """
+
+    def __init__(self, writer, write_id):
+        self.writer = writer
+        self.id = write_id
+
+    def status(self):
+        """
+        @return: { 'status': pending | sending | sent | failed,
+                   'attempts', 'result', 'error' }
+        """
+        return self.writer.status(self.id)
+
+    def wait(self, timeout=None):
+        """
+        blocks until the write is sent or failed, or 'timeout' secs passed.
+        @return: the last 'status'
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        event = self.writer._events.get(self.id)
+
+        while True:
+            status = self.status()
+            if status['status'] in (SENT, FAILED):
+                return status
+
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return status
+
+            wait_for = 0.5 if remaining is None else min(0.5, remaining)
+            if event is not None:
+                event.wait(wait_for)
+            else:
+                time.sleep(wait_for)
+
+class BlacklistWriter(object):
+    """
+    durable, deduplicated and batched 'put_in_blacklist'.
+
+    @param path: sqlite spool, defaults to $BLACKLIST_SPOOL_PATH or
+                 'blacklist_spool.sqlite3' in 'client.cache.private_dir()'.
+                 a new file is created 0600. several processes of the same
+                 user can share it.
+    @param batch_size: writes taken from the spool per round
+    @param concurrency: requests in flight per round
+    @param max_attempts: attempts before a write is marked as failed
+    @param backoff: first retry delay in secs, doubled on every attempt up
+                    to 'max_backoff'
+    @param retention: secs sent / failed writes are kept in the spool after
+                      their last attempt, for 'status'
+
+    the first 'put' starts the sender, unless 'stop' was called.
+
+    a pending write for the same lead (same unique_identifier, area,
+    phone_number, email and cbu) is not queued twice, 'put' returns the
+    handle of the one already waiting.
+    """
+
+    DEFAULT_PATH = os.environ.get('BLACKLIST_SPOOL_PATH')
+
+    DEFAULT_RETENTION = int(os.environ.get('BLACKLIST_SPOOL_RETENTION', 7 * 24 * 3600))
+
+    # a 'sending' write not finished after this many secs is retried
+    LEASE_TIMEOUT = 300
+    # secs between purges of the finished writes
+    PURGE_INTERVAL = 3600
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, blacklist=None, path=None, batch_size=50, concurrency=5,
+                 max_attempts=10, backoff=10, max_backoff=600, poll_interval=1,
+                 retention=DEFAULT_RETENTION):
+        self.blacklist = blacklist or Blacklist()
+        self.path = path or self.DEFAULT_PATH or os.path.join(private_dir(), 'blacklist_spool.sqlite3')
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._events = {}
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        # the spool is sent with the service token: nobody else may write it
+        create_private(self.path)
+        connection = self._connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS blacklist_writes ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'dedup_key TEXT NOT NULL, '
+                               'lead TEXT NOT NULL, '
+                               'reason TEXT, '
+                               'status TEXT NOT NULL, '
+                               'attempts INTEGER NOT NULL DEFAULT 0, '
+                               'next_attempt_at REAL NOT NULL, '
+                               'created_at REAL NOT NULL, '
+                               'result TEXT, '
+                               'error TEXT)')
+            connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS blacklist_writes_pending '
+                               'ON blacklist_writes (dedup_key) '
+                               "WHERE status IN ('pending', 'sending')")
+            connection.execute('CREATE INDEX IF NOT EXISTS blacklist_writes_next '
+                               'ON blacklist_writes (status, next_attempt_at)')
+
+    def _connection(self):
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    # ---- producer
+
+    def put(self, lead, reason):
+        """
+        queues a 'put_in_blacklist' and returns at once.
+        @return: 'BlacklistWrite' handle
+        """
+        lead = dict((field, lead.get(field, '')) for field in LEAD_FIELDS)
+        dedup_key = json.dumps([lead[field] for field in LEAD_FIELDS])
+        now = time.time()
+
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO blacklist_writes '
+                               '(dedup_key, lead, reason, status, next_attempt_at, created_at) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (dedup_key, json.dumps(lead), reason, PENDING, now, now))
+            write_id = connection.execute('SELECT id FROM blacklist_writes '
+                                          'WHERE dedup_key = ? AND status IN (?, ?)',
+                                          (dedup_key, PENDING, SENDING)).fetchone()[0]
+
+        self._events.setdefault(write_id, threading.Event())
+        self._wakeup.set()
+        if self._thread is None and not self._stopping.is_set():
+            self.start()
+        return BlacklistWrite(self, write_id)
+
+    def status(self, write_id):
+
+        row = self._connection().execute('SELECT status, attempts, result, error '
+                                         'FROM blacklist_writes WHERE id = ?',
+                                         (write_id,)).fetchone()
+        if row is None:
+            raise self.Error('unknown write: %s' % write_id)
+
+        return  {
+                    'status': row[0],
+                    'attempts': row[1],
+                    'result': json.loads(row[2]) if row[2] else None,
+                    'error': row[3]
+                }
+
+    def pending_count(self):
+
+        return self._connection().execute('SELECT COUNT(*) FROM blacklist_writes '
+                                          'WHERE status IN (?, ?)',
+                                          (PENDING, SENDING)).fetchone()[0]
+
+    def purge(self):
+        """
+        deletes the sent / failed writes whose last attempt is older than
+        'retention' secs ('status' of them raises afterwards).
+        @return: number of writes deleted
+        """
+        connection = self._connection()
+        with connection:
+            # 'next_attempt_at' of a finished write is its last attempt
+            cursor = connection.execute('DELETE FROM blacklist_writes '
+                                        'WHERE status IN (?, ?) AND next_attempt_at < ?',
+                                        (SENT, FAILED, time.time() - self.retention))
+        return cursor.rowcount
+
+    # ---- consumer
+
+    def _claim(self):
+
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # writes left 'sending' by a dead worker
+            connection.execute('UPDATE blacklist_writes SET status = ? '
+                               'WHERE status = ? AND next_attempt_at < ?',
+                               (PENDING, SENDING, now - self.LEASE_TIMEOUT))
+            rows = connection.execute('SELECT id, lead, reason, attempts FROM blacklist_writes '
+                                      'WHERE status = ? AND next_attempt_at <= ? '
+                                      'ORDER BY next_attempt_at LIMIT ?',
+                                      (PENDING, now, self.batch_size)).fetchall()
+            connection.executemany('UPDATE blacklist_writes SET status = ?, next_attempt_at = ? '
+                                   'WHERE id = ?',
+                                   [(SENDING, now, row[0]) for row in rows])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        return rows
+
+    def _send(self, row):
+
+        write_id, lead, reason, attempts = row
+        lead = json.loads(lead)
+        blacklist = self.blacklist
+
+        status_code, text, response_time = blacklist._send('POST', blacklist._put_in_blacklist_url(lead, reason))
+        if status_code == 204:
+            raise blacklist.Error('204 - not created yet')
+
+        result = blacklist._put_in_blacklist_response(lead, status_code, text, response_time)
+        return { 'messsage': result['messsage'], 'response_time': str(response_time) }
+
+    def _finish(self, row, result, error):
+
+        write_id, attempts = row[0], row[3] + 1
+        connection = self._connection()
+
+        with connection:
+            if error is None:
+                connection.execute('UPDATE blacklist_writes SET status = ?, attempts = ?, '
+                                   'result = ?, error = NULL WHERE id = ?',
+                                   (SENT, attempts, json.dumps(result), write_id))
+            elif attempts >= self.max_attempts:
+                connection.execute('UPDATE blacklist_writes SET status = ?, attempts = ?, '
+                                   'error = ? WHERE id = ?',
+                                   (FAILED, attempts, str(error), write_id))
+            else:
+                delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                connection.execute('UPDATE blacklist_writes SET status = ?, attempts = ?, '
+                                   'error = ?, next_attempt_at = ? WHERE id = ?',
+                                   (PENDING, attempts, str(error), time.time() + delay, write_id))
+
+        if error is None or attempts >= self.max_attempts:
+            event = self._events.pop(write_id, None)
+            if event is not None:
+                event.set()
+
+    def process_batch(self):
+        """
+        sends one round of due writes.
+        @return: number of writes attempted
+        """
+        rows = self._claim()
+        for item in run_many(self._send, rows, self.concurrency):
+            self._finish(rows[item['index']], item['result'], item['error'])
+
+        return len(rows)
+
+    def _run(self):
+
+        next_purge = time.time()
+        while not self._stopping.is_set():
+            try:
+                if time.time() >= next_purge:
+                    next_purge = time.time() + self.PURGE_INTERVAL
+                    self.purge()
+                if self.process_batch():
+                    continue
+            except Exception as err:
+                print('blacklist writer error: %s' % err)
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def start(self):
+        """
+        starts the background sender (daemon thread), done by the first
+        'put'.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='blacklist-writer')
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        stops the sender after the current round. pending writes stay in
+        the spool and are sent by the next 'start'.
+        """
+        with self._lock:
+            self._stopping.set()
+            self._wakeup.set()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
@@ -6,17 +6,123 @@ cendeu module
 import json
 import os
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
 
-from dotenv import load_dotenv, find_dotenv 
-# https://github.com/theskumar/python-dotenv#installation
+from ..client.session import get_session, get_async_session, \
+                             DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE
+from ..client.batch import run_many, DEFAULT_CONCURRENCY
+from ..client.singleflight import SingleFlight
+from ..client.env import load_env
 
 # ----
 
-dotenv_path = find_dotenv() 
-load_dotenv(dotenv_path)
+load_env()
+
+# ---- situations
+
+def _situation_cutoffs(current_date=None):
+    """
+    iso dates from which a debt counts for the current (last 3 months),
+    last 12 months and last 24 months situations.
+    """
+    if current_date is None:
+        current_date = datetime.now().date()
+    current_date = current_date.replace(day=1)
+
+    return  (
+                (current_date - relativedelta(months=2)).isoformat(),
+                (current_date - relativedelta(months=12)).isoformat(),
+                (current_date - relativedelta(months=24)).isoformat()
+            )
+
+def aggregate_situations(debts, current_date=None):
+    """
+    worst situations of a cendeu 'raw_data' (list of debts with
+    'situation' and 'information_date' as 'YYYY-MM-DD') in a single pass.
+
+    @param current_date: reference date, defaults to today
+    @return: { 'cendeu_worst_situation', 'cendeu_current_situation',
+               'cendeu_worst_situation_last_12_months',
+               'cendeu_worst_situation_last_24_months' }
+
+    debts outside a window count as situation 0 for it. dates are compared
+    as iso strings, so they are never parsed.
+    """
+    current_cutoff, last_12_cutoff, last_24_cutoff = _situation_cutoffs(current_date)
+
+    # TODO: se elimina después de que se implementen las nuevas worst_situation
+    worst = None
+    current = last_12 = last_24 = 0
+
+    for debt in debts:
+        situation = debt['situation']
+        information_date = debt['information_date']
+
+        if worst is None or situation > worst:
+            worst = situation
+
+        # peor situación últimos 24 / 12 / 3 meses
+        if information_date >= last_24_cutoff:
+            if situation > last_24:
+                last_24 = situation
+            if information_date >= last_12_cutoff:
+                if situation > last_12:
+                    last_12 = situation
+                if information_date >= current_cutoff and situation > current:
+                    current = situation
+
+    return  {
+                'cendeu_worst_situation': worst,
+                'cendeu_current_situation': current,
+                'cendeu_worst_situation_last_12_months': last_12,
+                'cendeu_worst_situation_last_24_months': last_24
+            }
+
+def aggregate_situations_batch(raw_datas, current_date=None):
+    """
+    numpy version of 'aggregate_situations' for many debtors at once.
+
+    @param raw_datas: iterable of cendeu 'raw_data' lists, one per debtor
+    @return: dict of arrays aligned with 'raw_datas': 'is_in_cendeu' (bool)
+             and the four 'cendeu_*' situations (int64). debtors without
+             debts get False and situation 0.
+    """
+    import numpy as np
+
+    raw_datas = raw_datas if isinstance(raw_datas, list) else list(raw_datas)
+    current_cutoff, last_12_cutoff, last_24_cutoff = _situation_cutoffs(current_date)
+
+    counts = np.fromiter((len(debts) for debts in raw_datas), dtype=np.int64,
+                         count=len(raw_datas))
+    total = int(counts.sum())
+
+    situations = np.fromiter((debt['situation'] for debts in raw_datas for debt in debts),
+                             dtype=np.int64, count=total)
+    dates = np.array([debt['information_date'] for debts in raw_datas for debt in debts],
+                     dtype='datetime64[D]')
+
+    # debts are contiguous per debtor: reduce each non-empty group at its offset
+    is_in_cendeu = counts > 0
+    starts = (np.cumsum(counts) - counts)[is_in_cendeu]
+
+    def group_max(values):
+        result = np.zeros(len(raw_datas), dtype=np.int64)
+        if total:
+            result[is_in_cendeu] = np.maximum.reduceat(values, starts)
+        return result
+
+    def window_max(cutoff):
+        return group_max(np.where(dates >= np.datetime64(cutoff), situations, 0))
+
+    return  {
+                'is_in_cendeu': is_in_cendeu,
+                'cendeu_worst_situation': group_max(situations),
+                'cendeu_current_situation': window_max(current_cutoff),
+                'cendeu_worst_situation_last_12_months': window_max(last_12_cutoff),
+                'cendeu_worst_situation_last_24_months': window_max(last_24_cutoff)
+            }
 
 # ----
 
@@ -25,91 +131,196 @@ class Cendeu(object):
     API_CENDEU_TOKEN = os.environ.get('API_CENDEU_TOKEN')
     API_CENDEU_URL = os.environ.get('API_CENDEU_URL')
 
+    # cache ttl in seconds, cendeu data changes monthly
+    CACHE_TTL = int(os.environ.get('API_CENDEU_CACHE_TTL', 15 * 24 * 3600))
+    CACHE_NEGATIVE_TTL = int(os.environ.get('API_CENDEU_CACHE_NEGATIVE_TTL', 24 * 3600))
+
+    # in-flight lookups, shared by every instance in the process
+    _flight = SingleFlight()
+
     class Error(Exception):
         pass
 
-    def is_in_cendeu(self, lead, verbose=False):
-        
-        # query string params
-        qs_params = (
-                        self.API_CENDEU_URL,
-                        lead.get('unique_identifier', ''),
-                        self.API_CENDEU_TOKEN
-                    )
-        # url formation
-        url = '%s/api/cuit/%s?api_token=%s' % qs_params
+    def __init__(self,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 keep_alive=True,
+                 cache=None):
+        # pooled keep-alive session, shared by every instance in the process
+        self.session_options = {
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+            'keep_alive': keep_alive
+        }
+        # optional response cache ('client.cache.LRUCache' or 'DiskCache')
+        self.cache = cache
+
+    @property
+    def session(self):
+        return get_session('cendeu', **self.session_options)
+
+    @property
+    def async_session(self):
+        return get_async_session('cendeu', **self.session_options)
+
+    def _send(self, url):
+
         # send request
         try:
             t0 = datetime.now()
-            response = requests.get(url)
+            response = self.session.get(url)
             t1 = datetime.now()
         except requests.ConnectionError as err:
             error_message = 'CONNECTION_ERROR - %s' % err
             raise self.Error(error_message)
-        
-        # handle ok response
-        if response.status_code == 200:
 
-            raw_data = json.loads(response.text).get('debts', [])
-            if raw_data:
-                # TODO: se elimina después de que se implementen las nuevas worst_situation
-                cendeu_worst_situation = max([debt['situation'] for debt in raw_data])
+        return response.status_code, response.text, t1-t0
 
-                current_date = datetime.now().replace(day=1).date()
-                worst_situation_last_12_months_date = current_date - relativedelta(months=12)
-                worst_situation_last_24_months_date = current_date - relativedelta(months=24)
-                
-                cendeu_current_situation_list = []
-                cendeu_worst_situation_last_12_months_list = []
-                cendeu_worst_situation_last_24_months_list = []
-
-                for i in raw_data:
-                    information_date = datetime.strptime(i['information_date'], '%Y-%m-%d').date()
-
-                    # peor última situación en los últimos 3 meses, sino 0
-                    if information_date >= current_date:
-                        cendeu_current_situation_list.append(i['situation'])
-                    elif information_date >= current_date - relativedelta(months=1):
-                        cendeu_current_situation_list.append(i['situation'])
-                    elif information_date >= current_date - relativedelta(months=2):
-                        cendeu_current_situation_list.append(i['situation'])
-                    else:
-                        cendeu_current_situation_list.append(0)
-
-                    # peor situación últimos 12 meses
-                    if information_date >= worst_situation_last_12_months_date:
-                        cendeu_worst_situation_last_12_months_list.append(i['situation'])
-                    else:
-                        cendeu_worst_situation_last_12_months_list.append(0)                        
-
-                    # peor situación últimos 24 meses
-                    if information_date >= worst_situation_last_24_months_date:
-                        cendeu_worst_situation_last_24_months_list.append(i['situation'])
-                    else:
-                        cendeu_worst_situation_last_24_months_list.append(0)
+    async def _send_async(self, url):
+        import aiohttp
 
-                
-                cendeu_current_situation = max(cendeu_current_situation_list)
-                cendeu_worst_situation_last_12_months = max(cendeu_worst_situation_last_12_months_list)
-                cendeu_worst_situation_last_24_months = max(cendeu_worst_situation_last_24_months_list)
+        # send request
+        try:
+            t0 = datetime.now()
+            async with self.async_session.get(url) as response:
+                status_code = response.status
+                text = await response.text()
+            t1 = datetime.now()
+        except aiohttp.ClientConnectionError as err:
+            error_message = 'CONNECTION_ERROR - %s' % err
+            raise self.Error(error_message)
 
-                data =  { 
-                            'is_in_cendeu': True,
-                            'cendeu_worst_situation': cendeu_worst_situation,
-                            'cendeu_current_situation': cendeu_current_situation,
-                            'cendeu_worst_situation_last_12_months': cendeu_worst_situation_last_12_months,
-                            'cendeu_worst_situation_last_24_months': cendeu_worst_situation_last_24_months
+        return status_code, text, t1-t0
 
-                        }
+    # ---- cache
+
+    def _cache_key(self, lead):
+        return 'cendeu:%s' % lead.get('unique_identifier', '')
+
+    def _cache_set(self, key, result):
+
+        # only the debts are cached: the situation windows move with the
+        # month, so they are aggregated again on every read
+        raw_data = result.get('raw_data', [])
+        entry = {
+                    'raw_data': raw_data,
+                    'response_time': result['response_time'].total_seconds()
+                }
+        if raw_data:
+            self.cache.set(key, entry, self.CACHE_TTL)
+        else:
+            self.cache.set(key, entry, self.CACHE_NEGATIVE_TTL)
+
+    def _cached_result(self, entry, verbose):
+
+        if not verbose:
+            return bool(entry['raw_data'])
+        return self._verbose_result(entry['raw_data'], timedelta(seconds=entry['response_time']))
+
+    def _verbose_result(self, raw_data, response_time):
+
+        if not raw_data:
+            return  {
+                        'data': { 'is_in_cendeu': False },
+                        'response_time': response_time
+                    }
+
+        data = { 'is_in_cendeu': True }
+        data.update(aggregate_situations(raw_data))
+
+        return  {
+                    'data': data,
+                    'raw_data': raw_data,
+                    'response_time': response_time
+                }
+
+    # ---- is_in_cendeu
+
+    def _is_in_cendeu_url(self, lead):
+
+        # query string params
+        qs_params = (
+                        self.API_CENDEU_URL,
+                        lead.get('unique_identifier', ''),
+                        self.API_CENDEU_TOKEN
+                    )
+        # url formation
+        return '%s/api/cuit/%s?api_token=%s' % qs_params
+
+    def _fetch(self, url, verbose, cache_key=None):
+
+        status_code, text, response_time = self._send(url)
+        result = self._is_in_cendeu_response(status_code, text, response_time, verbose)
+        if cache_key is not None:
+            self._cache_set(cache_key, result)
+        return result
+
+    async def _fetch_async(self, url, verbose, cache_key=None):
+
+        status_code, text, response_time = await self._send_async(url)
+        result = self._is_in_cendeu_response(status_code, text, response_time, verbose)
+        if cache_key is not None:
+            self._cache_set(cache_key, result)
+        return result
+
+    def is_in_cendeu(self, lead, verbose=False):
+
+        url = self._is_in_cendeu_url(lead)
+
+        # concurrent calls for the same cuit share one request
+        if self.cache is None:
+            return self._flight.do((url, verbose), lambda: self._fetch(url, verbose))
+
+        key = self._cache_key(lead)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return self._cached_result(entry, verbose)
+
+        result = self._flight.do((url, True), lambda: self._fetch(url, True, key))
+        return result if verbose else result['data']['is_in_cendeu']
+
+    async def is_in_cendeu_async(self, lead, verbose=False):
+
+        url = self._is_in_cendeu_url(lead)
+
+        # concurrent calls for the same cuit share one request
+        if self.cache is None:
+            return await self._flight.do_async((url, verbose), lambda: self._fetch_async(url, verbose))
+
+        key = self._cache_key(lead)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return self._cached_result(entry, verbose)
+
+        result = await self._flight.do_async((url, True), lambda: self._fetch_async(url, True, key))
+        return result if verbose else result['data']['is_in_cendeu']
+
+    def is_in_cendeu_many(self, leads, concurrency=DEFAULT_CONCURRENCY, verbose=False):
+        """
+        runs 'is_in_cendeu' over an iterable of leads with at most
+        'concurrency' requests in flight and yields, as each one finishes,
+        { 'index', 'result', 'error' } (see 'client.batch.run_many').
+
+        keep 'pool_maxsize' >= 'concurrency' so every request reuses a
+        pooled connection.
+        """
+        return run_many(lambda lead: self.is_in_cendeu(lead, verbose=verbose),
+                        leads, concurrency)
+
+    def _is_in_cendeu_response(self, status_code, text, response_time, verbose):
+
+        # handle ok response
+        if status_code == 200:
+
+            raw_data = json.loads(text).get('debts', [])
+            if raw_data:
 
                 if not verbose:
                     return True
                 else:
-                    return  {
-                                'data': data,
-                                'raw_data': raw_data,
-                                'response_time': t1-t0
-                            }
+                    return self._verbose_result(raw_data, response_time)
             
             # ok not ok case:
             else:
@@ -119,21 +330,21 @@ class Cendeu(object):
                 else:
                     return  {
                                 'data': { 'is_in_cendeu': False },
-                                'response_time': t1-t0
+                                'response_time': response_time
                             }
 
         # handle not ok response
-        elif response.status_code == 204:
+        elif status_code == 204:
             
             if not verbose:
                 return False
             else:
                 return  {
                             'data': { 'is_in_cendeu': False },
-                            'response_time': t1-t0
+                            'response_time': response_time
                         }
         
         # handle error response
         else:
-            error_message = '%s - %s' % (response.status_code, response.text) 
+            error_message = '%s - %s' % (status_code, text) 
             raise self.Error(error_message)
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+batch module
+
+bounded-concurrency runner behind the '*_many' lookups of the bureau clients,
+the producer threads behind the parallel readers, and the buffer +
+background thread shared by the batched writers.
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# ----
+
+DEFAULT_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 10))
+
+# ----
+
+def run_many(func, items, concurrency=DEFAULT_CONCURRENCY):
+    """
+    calls 'func(item)' for every item of the iterable 'items' with at most
+    'concurrency' calls in flight, and yields as each one finishes:
+
+        { 'index': position of the item in 'items',
+          'result': func(item) or None,
+          'error': the raised exception or None }
+
+    'items' is consumed lazily, so it can be a generator over millions of
+    rows. results come out in completion order, not in input order.
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be >= 1')
+
+    items = enumerate(items)
+    executor = ThreadPoolExecutor(max_workers=concurrency,
+                                  thread_name_prefix='run_many')
+    in_flight = {}
+
+    def submit_next():
+        for index, item in items:
+            in_flight[executor.submit(func, item)] = index
+            return True
+        return False
+
+    try:
+        while len(in_flight) < concurrency and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = in_flight.pop(future)
+                error = future.exception()
+                yield {
+                    'index': index,
+                    'result': future.result() if error is None else None,
+                    'error': error
+                }
+                submit_next()
+    finally:
+        # the caller may stop iterating early
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+# ---- parallel readers
+
+_PRODUCER_DONE = object()
+
+def merge_threads(producers, queue_size=10, max_workers=None, thread_name_prefix='merge_threads'):
+    """
+    runs every 'producer(emit)' in a thread and yields what they emit, in
+    arrival order, with at most 'queue_size' items read ahead.
+
+    'emit(item)' returns False once the consumer went away, the producer
+    should then return. the first exception of a producer is raised to the
+    consumer. closing the generator early stops the producers at their
+    next 'emit' and cancels the ones not started.
+
+    @param max_workers: producers running at the same time, all by default
+    """
+    producers = list(producers)
+    if not producers:
+        return
+
+    items = queue.Queue(maxsize=queue_size)
+    stopping = threading.Event()
+
+    def put(item):
+        # gives up if the consumer went away
+        while not stopping.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(producer):
+        try:
+            producer(lambda item: put((item, None)))
+        except Exception as err:
+            put((None, err))
+        finally:
+            put((_PRODUCER_DONE, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(producers),
+                                  thread_name_prefix=thread_name_prefix)
+    try:
+        for producer in producers:
+            executor.submit(run, producer)
+
+        running = len(producers)
+        while running:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _PRODUCER_DONE:
+                running -= 1
+                continue
+            yield item
+    finally:
+        stopping.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# ---- background flusher
+
+class BackgroundFlusher(object):
+    """
+    buffer sent in batches by a daemon thread, every 'flush_interval' secs
+    or as soon as it is full. base of 'data.dynamodb.BatchWriter' and
+    'data.elastic.BulkIndexer'.
+
+    @param flush_interval: max secs an item waits in the buffer
+    @param max_pending: buffered items before '_put' blocks
+
+    subclasses implement '_is_full()', '_pop_pending()' (items to send
+    next, called with the condition held) and '_send_pending(items)', and
+    may override '_append(item)'.
+    """
+
+    THREAD_NAME = 'flusher'
+    FULL_ERROR = 'FLUSHER_FULL'
+    CLOSED_ERROR = 'FLUSHER_CLOSED'
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, flush_interval, max_pending):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._pending = deque()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    # ---- producer
+
+    def _append(self, item):
+        self._pending.append(item)
+
+    def _put(self, item, timeout=None):
+        """
+        buffers 'item', blocking while 'max_pending' items are waiting.
+        @raise: self.Error if closed or still full after 'timeout' secs
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._condition:
+            while len(self._pending) >= self.max_pending and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise self.Error('%s - %s pending' % (self.FULL_ERROR, len(self._pending)))
+                self._condition.wait(remaining)
+
+            if self._closed:
+                raise self.Error(self.CLOSED_ERROR)
+
+            self._append(item)
+            if self._is_full():
+                self._condition.notify_all()
+
+        if self._thread is None:
+            self.start()
+
+    # ---- consumer
+
+    def _take(self):
+
+        with self._condition:
+            items = self._pop_pending()
+            self._in_flight += len(items)
+            self._condition.notify_all()
+        return items
+
+    def _flush_items(self, items):
+
+        try:
+            self._send_pending(items)
+        finally:
+            with self._condition:
+                self._in_flight -= len(items)
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        sends everything buffered and waits for the batches in flight, for
+        at most 'timeout' secs. the timeout is checked between batches: a
+        send already started is not interrupted.
+        @return: True if nothing is left buffered or in flight
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            items = self._take()
+            if items:
+                self._flush_items(items)
+            else:
+                with self._condition:
+                    if not self._in_flight and not self._pending:
+                        return True
+                    if self._in_flight:
+                        self._condition.wait(None if deadline is None
+                                             else max(deadline - time.time(), 0))
+
+            if deadline is not None and time.time() >= deadline:
+                return not self.pending
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                if not self._is_full() and not self._closed:
+                    self._condition.wait(self.flush_interval)
+                if self._closed and not self._pending:
+                    return
+
+            items = self._take()
+            if items:
+                self._flush_items(items)
+
+    def start(self):
+        """
+        starts the background flusher (daemon thread), done by the first
+        put.
+        """
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.THREAD_NAME)
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def close(self, timeout=None):
+        """
+        stops taking items, sends the buffered ones and stops the flusher,
+        waiting at most 'timeout' secs (see 'flush'). past the timeout the
+        flusher keeps sending in the background.
+        @return: True if everything was sent
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                # stalled sends: the flusher drains the buffer when they return
+                return False
+
+        return self.flush(None if deadline is None else max(deadline - time.time(), 0))
+
+    @property
+    def pending(self):
+        return len(self._pending) + self._in_flight
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+cache module
+
+ttl caches for bureau responses. both backends share the same interface:
+
+    cache.get(key)              -> value or None (missing or expired)
+    cache.set(key, value, ttl)  -> ttl in seconds
+    cache.delete(key)
+    cache.clear()
+
+'LRUCache' lives in the process, 'DiskCache' is a sqlite file shared by
+every worker of a host.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# ---- private files
+
+def private_dir():
+    """
+    per-user directory for cache and spool files, $XDG_CACHE_HOME/risk_utils
+    or ~/.cache/risk_utils, created 0700.
+    @raise: OSError if it belongs to another user
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'risk_utils')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    if hasattr(os, 'getuid'):
+        info = os.stat(path)
+        if info.st_uid != os.getuid():
+            raise OSError('%s belongs to another user' % path)
+        if info.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    return path
+
+def create_private(path):
+    """
+    creates 'path' readable and writable by its owner only (0600) if it
+    does not exist. sqlite creates its -wal / -shm files with the same mode.
+    """
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    os.close(fd)
+
+# ----
+
+class LRUCache(object):
+    """
+    thread-safe in-process cache, evicts the least recently used entry once
+    'maxsize' entries are stored.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class DiskCache(object):
+    """
+    sqlite backed cache, safe to share between threads and processes of the
+    same user on a host. values are stored as json (tuples come back as
+    lists), never pickled: whoever can write the file can't run code.
+
+    @param path: sqlite file, defaults to $BUREAU_CACHE_PATH or
+                 'bureau_cache.sqlite3' in 'private_dir()'. a new file is
+                 created 0600.
+    """
+
+    DEFAULT_PATH = os.environ.get('BUREAU_CACHE_PATH')
+
+    # purge expired rows every n writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path=None, timeout=30):
+        self.path = path or self.DEFAULT_PATH or os.path.join(private_dir(), 'bureau_cache.sqlite3')
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+
+        create_private(self.path)
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                           'key TEXT PRIMARY KEY, '
+                           'value BLOB NOT NULL, '
+                           'expires_at REAL NOT NULL)')
+        connection.commit()
+
+    def _connection(self):
+
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return connection
+
+    def get(self, key):
+
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at >= ?',
+            (key, time.time())).fetchone()
+
+        if row is None:
+            return None
+
+        try:
+            return json.loads(row[0])
+        except (TypeError, ValueError):
+            # a value of an older, pickling version: a miss
+            return None
+
+    def set(self, key, value, ttl):
+
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time() + ttl))
+
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, key):
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM cache')
+
+    def purge(self):
+        """
+        removes the expired entries.
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),))
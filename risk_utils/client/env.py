@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+env module
+
+loads the .env file once per process, however many modules ask for it.
+"""
+import threading
+
+# ----
+
+_loaded = False
+_lock = threading.Lock()
+
+def load_env():
+    """
+    finds the .env file (walking up from this package) and loads it into
+    os.environ without overriding variables already set. only the first
+    call does any work.
+    """
+    global _loaded
+
+    if _loaded:
+        return
+
+    with _lock:
+        if _loaded:
+            return
+
+        from dotenv import load_dotenv, find_dotenv
+        # https://github.com/theskumar/python-dotenv#installation
+
+        load_dotenv(find_dotenv())
+        _loaded = True
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+session module
+
+shared keep-alive http sessions for the bureau clients (Cendeu, Nosis,
+Blacklist). one pooled session per (name, options) and per process, so
+every client instance in a worker reuses the same TCP/TLS connections.
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ----
+
+# number of per-host connection pools kept by each session
+DEFAULT_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 10))
+# max connections kept alive per host
+DEFAULT_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))
+
+# ----
+
+_sessions = {}
+_sessions_pid = os.getpid()
+_sessions_lock = threading.Lock()
+
+def _new_session(pool_connections, pool_maxsize, pool_block, keep_alive):
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          pool_block=pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if keep_alive:
+        session.headers['Connection'] = 'keep-alive'
+    else:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+def get_session(name,
+                pool_connections=DEFAULT_POOL_CONNECTIONS,
+                pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                pool_block=False,
+                keep_alive=True):
+    """
+    returns the process-wide pooled session for 'name'.
+
+    @param pool_connections: number of hosts whose pools are cached
+    @param pool_maxsize: max connections kept per host
+    @param pool_block: if True, never open more than 'pool_maxsize'
+                       connections to a host, callers wait for a free one
+    @param keep_alive: reuse connections between requests
+
+    the session is safe to share between threads (urllib3 pools are
+    thread-safe); after a fork the child gets its own sessions.
+    """
+    global _sessions_pid
+
+    key = (name, pool_connections, pool_maxsize, pool_block, keep_alive)
+
+    with _sessions_lock:
+        # forked worker: never share sockets with the parent
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(key)
+        if session is None:
+            session = _new_session(pool_connections, pool_maxsize,
+                                   pool_block, keep_alive)
+            _sessions[key] = session
+
+    return session
+
+def close_sessions():
+    """
+    closes every pooled session of the current process.
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+# ---- asyncio
+
+_async_sessions = weakref.WeakKeyDictionary()
+
+def get_async_session(name,
+                      pool_connections=DEFAULT_POOL_CONNECTIONS,
+                      pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                      pool_block=False,
+                      keep_alive=True):
+    """
+    asyncio counterpart of 'get_session': returns the aiohttp session for
+    'name' bound to the running event loop. must be called from a coroutine.
+
+    'pool_maxsize' maps to the per-host connection limit and the total
+    limit is 'pool_connections' * 'pool_maxsize'. aiohttp always waits for
+    a free connection, so 'pool_block' is accepted only for symmetry.
+    """
+    import aiohttp
+    # https://docs.aiohttp.org/en/stable/client_advanced.html#limiting-connection-pool-size
+
+    loop = asyncio.get_running_loop()
+    sessions = _async_sessions.setdefault(loop, {})
+
+    key = (name, pool_connections, pool_maxsize, pool_block, keep_alive)
+    session = sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=pool_connections * pool_maxsize,
+                                         limit_per_host=pool_maxsize,
+                                         force_close=not keep_alive)
+        session = aiohttp.ClientSession(connector=connector)
+        sessions[key] = session
+
+    return session
+
+async def close_async_sessions():
+    """
+    closes every aiohttp session bound to the running event loop.
+    """
+    sessions = _async_sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+singleflight module
+
+coalesces identical in-flight calls: while a call for a key is running,
+other threads / tasks asking for the same key wait for it and get its
+result (or its exception) instead of running their own.
+"""
+import asyncio
+import threading
+import weakref
+
+# ----
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    callers share the same result object, treat it as read-only.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._async_calls = weakref.WeakKeyDictionary()
+
+    def do(self, key, func):
+        """
+        runs 'func()' unless a call for 'key' is already in flight, in which
+        case it waits for that one.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    async def do_async(self, key, coro_func):
+        """
+        asyncio version of 'do', 'coro_func()' returns the coroutine to run.
+        calls are coalesced per event loop.
+        """
+        loop = asyncio.get_running_loop()
+        calls = self._async_calls.setdefault(loop, {})
+
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(coro_func())
+            task.add_done_callback(lambda _: calls.pop(key, None))
+
+        # a cancelled waiter must not cancel the call for the others
+        return await asyncio.shield(task)
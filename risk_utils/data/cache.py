@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+query cache module
+
+size-bounded ttl cache for 'get_data_by_query' results, invalidated by the
+tables the queries touch.
+"""
+import os
+import re
+import time
+
+from ..client.cache import LRUCache
+
+# ----
+
+QUERY_CACHE_TTL = int(os.environ.get('DB_QUERY_CACHE_TTL', 300))
+
+_TABLE = r'[\w.`"\[\]]+'
+# a table with an optional alias that is not the next clause
+_TABLE_ALIAS = (_TABLE + r'(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|'
+                r'NATURAL|ON|USING|GROUP|ORDER|HAVING|LIMIT|UNION|WINDOW)\b)\w+)?')
+
+_TABLES_RE = re.compile(r'\b(?:JOIN|INTO|UPDATE)\s+(' + _TABLE + ')', re.IGNORECASE)
+# FROM a, b x, c AS y
+_FROM_RE = re.compile(r'\bFROM\s+(' + _TABLE_ALIAS + r'(?:\s*,\s*' + _TABLE_ALIAS + ')*)',
+                      re.IGNORECASE)
+_TABLE_RE = re.compile(_TABLE)
+# functions with a FROM of their own: extract(year FROM col), trim(' ' FROM col)...
+_FROM_FUNCTIONS_RE = re.compile(r'\b(?:EXTRACT|SUBSTRING|TRIM|POSITION|OVERLAY)\s*\([^()]*\)',
+                                re.IGNORECASE)
+
+def table_tag(table):
+    """
+    tag of a table name: last part, unquoted and lower case, so 'dbo.[Entidades]'
+    and 'entidades' are the same tag.
+    """
+    return re.sub(r'[`"\[\]]', '', table).rsplit('.', 1)[-1].lower()
+
+def query_tags(query):
+    """
+    tags of the tables named by the FROM (every table of a comma separated
+    list) / JOIN / INTO / UPDATE clauses of a sql query. the FROM inside
+    extract(), substring(), trim(), position() and overlay() is not a table
+    and is skipped.
+    """
+    query = _FROM_FUNCTIONS_RE.sub('', query)
+
+    tables = _TABLES_RE.findall(query)
+    for from_list in _FROM_RE.findall(query):
+        tables.extend(_TABLE_RE.match(item.strip()).group() for item in from_list.split(','))
+    return set(table_tag(table) for table in tables)
+
+class QueryCache(LRUCache):
+    """
+    @param maxsize: max cached queries
+    @param default_ttl: secs, used when a query doesn't set its own
+
+    one cache can be shared by any number of handlers, keys include the
+    engine, server and database.
+    """
+
+    def __init__(self, maxsize=1000, default_ttl=QUERY_CACHE_TTL):
+        super(QueryCache, self).__init__(maxsize)
+        self.default_ttl = default_ttl
+        self._tags = {} # tag -> keys
+        self._key_tags = {} # key -> tags
+
+    def set(self, key, value, ttl=None, tags=()):
+
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            self._untag(key)
+            self._key_tags[key] = tags = frozenset(tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self._untag(evicted)
+
+    def get(self, key):
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._data[key]
+                self._untag(key)
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def delete(self, key):
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._untag(key)
+
+    def _untag(self, key):
+
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, *tables):
+        """
+        drops every cached query tagged with one of 'tables'.
+        @return: number of queries dropped
+        """
+        dropped = 0
+        with self._lock:
+            for tag in set(table_tag(table) for table in tables):
+                for key in list(self._tags.get(tag, ())):
+                    self._untag(key)
+                    if self._data.pop(key, None) is not None:
+                        dropped += 1
+
+        return dropped
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self._key_tags.clear()
@@ -3,13 +3,17 @@
 """
 data module
 """
+import io
 import os
+import asyncio
+import functools
 import json
-
-import boto3
-import pymssql
-import MySQLdb
-import psycopg2
+import uuid
+import threading
+import tempfile
+from array import array
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 from datetime import datetime
 
@@ -19,15 +23,21 @@ from retrying import retry
 # ----
 
 from decimal import Decimal
-from requests_aws4auth import AWS4Auth
-from dynamodb_json import json_util as json_to_dynamodb
-from elasticsearch import Elasticsearch, RequestsHttpConnection
 
-from boto3.dynamodb.conditions import Key
+# drivers and sdks (boto3, pymssql, MySQLdb, psycopg2, elasticsearch,
+# requests_aws4auth, dynamodb_json) are imported by the handlers that use
+# them, on first use: importing this module stays cheap and works without
+# the drivers that are not needed.
 
 # ----
 
 from . import db_settings as cfg
+from ..client.batch import merge_threads
+from .pool import get_pool
+from .cache import query_tags
+from .dynamodb import to_item, BatchWriter
+from .elastic import BulkIndexer, search_pages
+from .policy import PolicyCache, parse_version, normalize, thaw
 
 # ---- 
 
@@ -49,86 +59,572 @@ def show_data_sources():
 
 # ---- SQL
 
-class psql_handler(object):
+# rows fetched per round trip when streaming
+ITERSIZE = int(os.environ.get('DB_STREAM_ITERSIZE', 2000))
+
+# rows per chunk in 'get_data_by_chunks'
+CHUNKSIZE = int(os.environ.get('DB_CHUNKSIZE', 10000))
+
+def _to_column(values):
+
+    sample = next((value for value in values if value is not None), None)
+
+    if None not in values:
+        if type(sample) is int:
+            try:
+                return array('q', values)
+            except (TypeError, OverflowError):
+                pass
+        elif type(sample) is float:
+            try:
+                return array('d', values)
+            except TypeError:
+                pass
+
+    return list(values)
+
+def _to_columns(rows, as_numpy=False):
+    """
+    transposes a list of row tuples into one sequence per column.
+    """
+    columns = zip(*rows)
+
+    if as_numpy:
+        import numpy as np
+        return [np.array(values) if None not in values else np.array(values, dtype='object')
+                for values in columns]
+
+    return [_to_column(values) for values in columns]
+
+# rows per commit in 'bulk_insert'
+BULK_CHUNKSIZE = int(os.environ.get('DB_BULK_CHUNKSIZE', 5000))
+
+# mysql 'LOAD DATA LOCAL INFILE' needs it enabled on the client connection
+MYSQL_LOCAL_INFILE = os.environ.get('DB_MYSQL_LOCAL_INFILE', '0') == '1'
+
+def _chunked(rows, size):
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _text_value(value):
+    """
+    value in postgres COPY / mysql LOAD DATA text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, str):
+        return (value.replace('\\', '\\\\')
+                     .replace('\t', '\\t')
+                     .replace('\n', '\\n')
+                     .replace('\r', '\\r'))
+    return str(value)
+
+def _text_lines(rows):
+    """
+    tab separated lines of 'rows', NULL as \\N.
+    """
+    return ''.join('\t'.join(_text_value(value) for value in row) + '\n'
+                   for row in rows)
+
+def _ping(connection):
+    """
+    health check used by the connection pools.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1')
+    cursor.fetchall()
+    cursor.close()
+    connection.rollback()
+
+class _sql_handler(object):
+    """
+    common behaviour of the sql handlers.
+
+    with pooled=True the connection is checked out from the process-wide
+    pool of (engine, server, database) and returned to it by 'close', at
+    the end of a 'with' block or when the handler is garbage collected:
+
+        with mysql_handler('Atenea', 'RISK_DATA', pooled=True) as db:
+            rows = list(db.get_data_by_query(query))
+
+    'pool_options' (see 'pool.ConnectionPool') size the pool when it is
+    created; passing different ones later raises ValueError.
+    """
+
+    ENGINE = None
+
+    def __init__(self, server, database, pooled=False, cache=None, **pool_options):
+        self.server = server
+        self.database = database
+        self.pooled = pooled
+        # optional 'cache.QueryCache' in front of 'get_data_by_query'
+        self.cache = cache
+
+        if pooled:
+            # the pool outlives the handler: don't let it hold 'self'
+            cls = type(self)
+            self.pool = get_pool((self.ENGINE, server, database),
+                                 lambda: cls._connect(server, database),
+                                 _ping,
+                                 **pool_options)
+            self.connection = self.pool.acquire()
+        else:
+            self.connection = self._connect(server, database)
+        self.cursor = self.connection.cursor()
+
+    @classmethod
+    def _connect(cls, server, database):
+        raise NotImplementedError
+
+    def _stream_cursor(self):
+        """
+        new server-side (unbuffered) cursor of the connection.
+        """
+        raise NotImplementedError
+
+    def get_data_by_query(self, query, query_params=None, stream=False, itersize=ITERSIZE,
+                          cache_ttl=None, cache_tags=None):
+        """
+        yields the rows of 'query'.
+
+        by default the driver loads the whole result in memory on execute.
+        with stream=True rows are read from the server 'itersize' at a time
+        through a server-side cursor, so memory stays flat. the connection
+        can't run other queries until the stream is consumed or closed.
+
+        if the handler has a cache, non streamed results are cached for
+        'cache_ttl' secs (the cache default if None, 0 skips the cache) and
+        tagged with 'cache_tags' (by default the tables in the query), see
+        'cache.QueryCache.invalidate'.
+        """
+        if stream:
+            return self._stream_rows(query, query_params, itersize)
+
+        if self.cache is not None and cache_ttl != 0:
+            return self._cached_rows(query, query_params, cache_ttl, cache_tags)
+
+        return self._buffered_rows(query, query_params)
+
+    def _cached_rows(self, query, query_params, cache_ttl, cache_tags):
+
+        key = (self.ENGINE, self.server, self.database, query, repr(query_params))
+
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = tuple(self._buffered_rows(query, query_params))
+            if cache_tags is None:
+                cache_tags = query_tags(query)
+            self.cache.set(key, rows, cache_ttl, cache_tags)
+
+        for row in rows:
+            yield row
+
+    def _buffered_rows(self, query, query_params):
+        
+        if query_params is not None:
+            self.cursor.execute(query, query_params)
+        else:
+            self.cursor.execute(query)
+        
+        for row in self.cursor:
+            yield row
+
+    def _batches(self, query, query_params, size, stream=True):
+        """
+        yields (cursor.description, rows) for every 'size' rows.
+        """
+        cursor = self._stream_cursor() if stream else self.connection.cursor()
+        try:
+            if query_params is not None:
+                cursor.execute(query, query_params)
+            else:
+                cursor.execute(query)
+
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield cursor.description, rows
+        finally:
+            cursor.close()
+
+    def _stream_rows(self, query, query_params, itersize):
+
+        for _, rows in self._batches(query, query_params, itersize):
+            for row in rows:
+                yield row
+
+    def get_data_by_chunks(self, query, query_params=None, chunksize=CHUNKSIZE,
+                           as_numpy=False, stream=True):
+        """
+        yields the result of 'query' in chunks of up to 'chunksize' rows,
+        column oriented:
+
+            { 'columns': [name, ...],
+              'types': [driver type code, ...],
+              'rows': number of rows in the chunk,
+              'data': { name: column values } }
+
+        columns are numpy arrays with as_numpy=True. otherwise int and float
+        columns are 'array.array' buffers ('q' / 'd') and any other column,
+        or one with NULLs, is a list.
+
+        with stream=True (default) the chunks are read through a
+        server-side cursor, see 'get_data_by_query'.
+        """
+        for description, rows in self._batches(query, query_params, chunksize, stream):
+            columns = [column[0] for column in description]
+
+            yield   {
+                        'columns': columns,
+                        'types': [column[1] for column in description],
+                        'rows': len(rows),
+                        'data': dict(zip(columns, _to_columns(rows, as_numpy)))
+                    }
+
+    def _write_chunk(self, cursor, table, columns, rows, **options):
+        raise NotImplementedError
+
+    def bulk_insert(self, table, columns, rows, chunksize=BULK_CHUNKSIZE, **options):
+        """
+        loads an iterator of row tuples into 'table' ('columns' in the same
+        order as the row values), committing every 'chunksize' rows. only
+        one chunk is held in memory. on error the current chunk is rolled
+        back, the chunks already committed stay.
+
+        @return: { 'rows', 'response_time', 'rows_per_second' }
+        """
+        rows_count = 0
+        cursor = self.connection.cursor()
+
+        t0 = datetime.now()
+        try:
+            for chunk in _chunked(rows, chunksize):
+                self._write_chunk(cursor, table, columns, chunk, **options)
+                self.connection.commit()
+                rows_count += len(chunk)
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            if self.cache is not None:
+                self.cache.invalidate(table)
+        t1 = datetime.now()
+
+        seconds = (t1-t0).total_seconds()
+        return  {
+                    'rows': rows_count,
+                    'response_time': t1-t0,
+                    'rows_per_second': rows_count / seconds if seconds else float(rows_count)
+                }
+
+    def close(self):
+
+        connection = self.__dict__.pop('connection', None)
+        if connection is None:
+            return
+
+        try:
+            self.cursor.close()
+        except Exception:
+            pass
+        self.cursor = None
+
+        if self.pooled:
+            self.pool.release(connection)
+        else:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+class psql_handler(_sql_handler):
+
+    ENGINE = 'psql'
 
     class Error(Exception):
         pass
     
     @retry(stop_max_attempt_number=5)
-    def __init__(self, server, database):
+    def __init__(self, server, database, pooled=False, cache=None, **pool_options):
+        super(psql_handler, self).__init__(server, database, pooled, cache, **pool_options)
+
+    @classmethod
+    def _connect(cls, server, database):
+        import psycopg2
+
         try:
-            self.connection = psycopg2.connect(
+            return psycopg2.connect(
                 host=cfg.PSQL_CONFIG[server][database]['host'],
                 user=cfg.PSQL_CONFIG[server][database]['user'],
                 password=cfg.PSQL_CONFIG[server][database]['password'],
                 port=cfg.PSQL_CONFIG[server][database]['port'],
                 dbname=cfg.PSQL_CONFIG[server][database]['database'])
-            self.cursor = self.connection.cursor()
         except psycopg2.OperationalError as err:
             error_message = 'CONNECTION_ERROR - %s' % err 
-            raise self.Error(error_message)
-        
-    def get_data_by_query(self, query, query_params=None):
-        
-        if query_params is not None:
-            self.cursor.execute(query, query_params)
-        else:
-            self.cursor.execute(query)
-        
-        for row in self.cursor:
-            yield row
-        
-    def __del__(self):
-        self.connection.close()
+            raise cls.Error(error_message)
 
-class mysql_handler(object):
+    def _stream_cursor(self):
+        # named cursor: psycopg2 declares it on the server
+        return self.connection.cursor(name='risk_utils_%s' % uuid.uuid4().hex)
 
-    def __init__(self, server, database):
-        
-        self.connection = MySQLdb.connect(
+    def _write_chunk(self, cursor, table, columns, rows):
+
+        from psycopg2 import sql
+
+        # COPY FROM STDIN in text format
+        query = sql.SQL('COPY {} ({}) FROM STDIN').format(
+            sql.Identifier(*table.split('.')),
+            sql.SQL(', ').join(sql.Identifier(column) for column in columns))
+
+        cursor.copy_expert(query.as_string(self.connection),
+                           io.StringIO(_text_lines(rows)))
+
+class mysql_handler(_sql_handler):
+
+    ENGINE = 'mysql'
+
+    @classmethod
+    def _connect(cls, server, database):
+        import MySQLdb
+
+        return MySQLdb.connect(
             host=cfg.MYSQL_CONFIG[server][database]['host'],
             user=cfg.MYSQL_CONFIG[server][database]['user'],
             passwd=cfg.MYSQL_CONFIG[server][database]['password'],
             db=cfg.MYSQL_CONFIG[server][database]['database'],
-            charset='utf8')
-        self.cursor = self.connection.cursor()
-        
-    def get_data_by_query(self, query, query_params=None):
-        
-        if query_params is not None:
-            self.cursor.execute(query, query_params)
+            charset='utf8',
+            local_infile=int(MYSQL_LOCAL_INFILE))
+
+    def _stream_cursor(self):
+        from MySQLdb.cursors import SSCursor
+
+        return self.connection.cursor(SSCursor)
+
+    def _write_chunk(self, cursor, table, columns, rows, method='insert'):
+        """
+        method='insert': multi-row INSERT (MySQLdb's executemany sends the
+        chunk as one statement). method='load_data': LOAD DATA LOCAL INFILE
+        from a temp file, needs DB_MYSQL_LOCAL_INFILE=1 and local_infile
+        enabled on the server.
+        """
+        table = '.'.join('`%s`' % name for name in table.split('.'))
+        column_list = ', '.join('`%s`' % column for column in columns)
+
+        if method == 'insert':
+            query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table, column_list, ', '.join(['%s'] * len(columns)))
+            cursor.executemany(query, rows)
+
+        elif method == 'load_data':
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.tsv') as data_file:
+                data_file.write(_text_lines(rows))
+                data_file.flush()
+                cursor.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s "
+                               "CHARACTER SET utf8 (%s)" % (table, column_list),
+                               (data_file.name,))
+
         else:
-            self.cursor.execute(query)
-        
-        for row in self.cursor:
-            yield row
+            raise ValueError('unknown bulk method: %s' % method)
 
-    def __del__(self):
-        self.connection.close()
+class sqlserver_handler(_sql_handler):
 
-class sqlserver_handler(object):
+    ENGINE = 'sqlserver'
     
-    def __init__(self, server, database):
-        
-        self.connection = pymssql.connect(
+    @classmethod
+    def _connect(cls, server, database):
+        import pymssql
+
+        return pymssql.connect(
             server=cfg.SQL_SERVER_CONFIG[server][database]['host'],
             user=cfg.SQL_SERVER_CONFIG[server][database]['user'],
             password=cfg.SQL_SERVER_CONFIG[server][database]['password'],
             database=cfg.SQL_SERVER_CONFIG[server][database]['database'])
-        self.cursor = self.connection.cursor()
-        
-    def get_data_by_query(self, query, query_params=None):
-        
-        if query_params is not None:
-            self.cursor.execute(query, query_params)
-        else:
-            self.cursor.execute(query)
-        
-        for row in self.cursor:
-            yield row
-        
-    def __del__(self):
-        self.connection.close()
+
+    def _stream_cursor(self):
+        # pymssql cursors read the rows from the tds stream as they are fetched
+        return self.connection.cursor()
+
+    def _write_chunk(self, cursor, table, columns, rows):
+
+        table = '.'.join('[%s]' % name for name in table.split('.'))
+        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table,
+            ', '.join('[%s]' % column for column in columns),
+            ', '.join(['%s'] * len(columns)))
+        cursor.executemany(query, rows)
+
+## fan-out
+
+def fan_out_query(query, query_params=None, server='Casarsa', databases=None,
+                  itersize=ITERSIZE, pooled=False, queue_size=50):
+    """
+    runs 'query' at the same time on several postgresql databases of
+    'server' that share a schema (by default every database of
+    PSQL_CONFIG[server]) and yields (database, row) as rows arrive.
+
+    each database is streamed with a server-side cursor in its own thread;
+    at most 'queue_size' batches of 'itersize' rows wait to be consumed.
+    the first failing database raises 'psql_handler.Error'. closing the
+    generator early stops every query.
+    """
+    databases = list(databases or cfg.PSQL_CONFIG[server].keys())
+    unknown = set(databases) - set(cfg.PSQL_CONFIG[server].keys())
+    if unknown:
+        raise ValueError('unknown %s databases: %s' % (server, sorted(unknown)))
+
+    def produce(database, emit):
+        handler = None
+        try:
+            handler = psql_handler(server, database, pooled=pooled)
+            rows = []
+            for row in handler.get_data_by_query(query, query_params, stream=True, itersize=itersize):
+                rows.append(row)
+                if len(rows) >= itersize:
+                    if not emit((database, rows)):
+                        return
+                    rows = []
+            if rows:
+                emit((database, rows))
+        except Exception as err:
+            raise psql_handler.Error('%s - %s' % (database, err))
+        finally:
+            if handler is not None:
+                handler.close()
+
+    producers = [functools.partial(produce, database) for database in databases]
+    for database, rows in merge_threads(producers, queue_size, thread_name_prefix='fan_out'):
+        for row in rows:
+            yield database, row
+
+## asyncio
+
+# threads running the blocking drivers for the async handlers
+ASYNC_MAX_WORKERS = int(os.environ.get('DB_ASYNC_MAX_WORKERS', 10))
+
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+def _get_async_executor():
+    global _async_executor
+
+    with _async_executor_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS,
+                                                 thread_name_prefix='async_sql')
+    return _async_executor
+
+class _async_sql_handler(object):
+    """
+    asyncio facade of a sql handler: every blocking driver call runs in a
+    bounded thread pool, so the event loop never waits on the database.
+
+        async with async_mysql_handler('Atenea', 'ATENEA_READ', pooled=True) as db:
+            async for row in db.get_data_by_query(query, stream=True):
+                ...
+
+    the connection is opened on first use. like the sync handlers, a
+    handler runs one query at a time; use one handler per task (pooled=True
+    makes that cheap) to query concurrently.
+    """
+
+    HANDLER = None
+
+    def __init__(self, server, database, **options):
+        self.server = server
+        self.database = database
+        self.options = options
+        self.handler = None
+
+    async def _run(self, func, *args, **kwargs):
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_async_executor(),
+                                          functools.partial(func, *args, **kwargs))
+
+    async def _get_handler(self):
+
+        if self.handler is None:
+            self.handler = await self._run(self.HANDLER, self.server, self.database, **self.options)
+        return self.handler
+
+    async def get_data_by_query(self, query, query_params=None, stream=False, itersize=ITERSIZE,
+                                **options):
+        """
+        async iterator over the rows of 'query', see the sync
+        'get_data_by_query'. rows are moved from the worker thread
+        'itersize' at a time.
+        """
+        handler = await self._get_handler()
+        rows = handler.get_data_by_query(query, query_params, stream=stream,
+                                         itersize=itersize, **options)
+
+        try:
+            while True:
+                batch = await self._run(lambda: list(islice(rows, itersize)))
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        finally:
+            await self._run(rows.close)
+
+    async def get_data_by_chunks(self, query, query_params=None, chunksize=CHUNKSIZE, **options):
+        """
+        async iterator over the chunks of 'get_data_by_chunks'.
+        """
+        handler = await self._get_handler()
+        chunks = handler.get_data_by_chunks(query, query_params, chunksize, **options)
+
+        try:
+            while True:
+                chunk = await self._run(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            await self._run(chunks.close)
+
+    async def bulk_insert(self, table, columns, rows, chunksize=BULK_CHUNKSIZE, **options):
+
+        handler = await self._get_handler()
+        return await self._run(handler.bulk_insert, table, columns, rows, chunksize, **options)
+
+    async def close(self):
+
+        if self.handler is not None:
+            handler, self.handler = self.handler, None
+            await self._run(handler.close)
+
+    async def __aenter__(self):
+        await self._get_handler()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+class async_psql_handler(_async_sql_handler):
+    HANDLER = psql_handler
+
+class async_mysql_handler(_async_sql_handler):
+    HANDLER = mysql_handler
+
+class async_sqlserver_handler(_async_sql_handler):
+    HANDLER = sqlserver_handler
 
 # ---- NO-SQL
 
@@ -140,28 +636,20 @@ class dynamodb_handler(object):
         - doc
         - get_document
         - update_document
-        - query / scan : [
-                from_datetime = datetime(2018, 8, 6, 12, 0, 0).strftime("%Y-%m-%dT%H:%M:%S")
-                to_datetime = datetime(2018, 8, 6, 12, 5, 0).strftime("%Y-%m-%dT%H:%M:%S")
-                fe = Key('timestamp').between(from_datetime, to_datetime) & \
-                    Key('environment').eq('production')
-                response = dd.table.scan(FilterExpression=fe)
-                data = response['Items']
-                while 'LastEvaluatedKey' in response:
-                    response = dd.table.scan(FilterExpression=fe,
-                                            ExclusiveStartKey=response['LastEvaluatedKey'])
-                    data.extend(response['Items'])
-            ]
+
+    scan / query yield the items page by page:
+
+        from boto3.dynamodb.conditions import Attr
+        fe = Attr('timestamp').between(from_datetime, to_datetime) & \
+             Attr('environment').eq('production')
+        for item in dd.scan('evaluations', filter_expression=fe, segments=8):
+            ...
     """
 
     def __init__(self):
+        import boto3
 
-        self.resource = boto3.resource(
-            'dynamodb',
-            endpoint_url=cfg.AWS_DYNAMODB_ENDPOINT,
-            aws_access_key_id=cfg.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=cfg.AWS_SECRET_ACCESS_KEY,
-            region_name=cfg.AWS_REGION_NAME)
+        self.resource = self._resource(boto3)
         
         self.client = boto3.client(
             'dynamodb',
@@ -173,11 +661,124 @@ class dynamodb_handler(object):
     @retry(stop_max_attempt_number=1)
     def save_document(self, raw_doc, table_name):
 
-        doc = json_to_dynamodb.dumps(raw_doc)
-        doc = doc.replace('"S": ""', '"NULL": true')
-        
+        # empty strings are stored as NULL
         return self.client.put_item(TableName=table_name,
-                                    Item=json.loads(doc))
+                                    Item=to_item(raw_doc))
+
+    def batch_writer(self, table_name, **options):
+        """
+        batched, background 'save_document', see 'dynamodb.BatchWriter'.
+        """
+        return BatchWriter(self.client, table_name, **options)
+
+    @staticmethod
+    def _resource(session):
+
+        return session.resource(
+            'dynamodb',
+            endpoint_url=cfg.AWS_DYNAMODB_ENDPOINT,
+            aws_access_key_id=cfg.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=cfg.AWS_SECRET_ACCESS_KEY,
+            region_name=cfg.AWS_REGION_NAME)
+
+    @staticmethod
+    def _read_options(projection, page_size, options):
+
+        if projection:
+            # placeholders, so reserved words ('status', 'timestamp') work
+            names = dict(options.get('ExpressionAttributeNames') or {})
+            placeholders = []
+            for i, attribute in enumerate(projection):
+                names['#p%d' % i] = attribute
+                placeholders.append('#p%d' % i)
+            options['ProjectionExpression'] = ', '.join(placeholders)
+            options['ExpressionAttributeNames'] = names
+        if page_size:
+            options['Limit'] = page_size
+        return options
+
+    @staticmethod
+    def _pages(read, options):
+        """
+        yields the 'Items' of every page of 'read(**options)', following
+        'LastEvaluatedKey'.
+        """
+        while True:
+            response = read(**options)
+            yield response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            options['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def query(self, table_name, key_condition, filter_expression=None, projection=None,
+              page_size=None, index_name=None, scan_forward=True, **options):
+        """
+        yields the items matching 'key_condition' (boto3.dynamodb.conditions.Key),
+        reading one page at a time.
+
+        @param projection: attribute names to read, all if None
+        @param page_size: items read per request ('Limit')
+        @param options: extra 'Table.query' arguments
+        """
+        options['KeyConditionExpression'] = key_condition
+        options['ScanIndexForward'] = scan_forward
+        if filter_expression is not None:
+            options['FilterExpression'] = filter_expression
+        if index_name:
+            options['IndexName'] = index_name
+        self._read_options(projection, page_size, options)
+
+        table = self.resource.Table(table_name)
+        for items in self._pages(table.query, options):
+            for item in items:
+                yield item
+
+    def scan(self, table_name, filter_expression=None, projection=None, page_size=None,
+             segments=1, max_workers=None, queue_size=50, **options):
+        """
+        yields every item of 'table_name' (matching 'filter_expression',
+        boto3.dynamodb.conditions.Attr).
+
+        @param projection: attribute names to read, all if None
+        @param page_size: items read per request ('Limit')
+        @param segments: > 1 splits the table in 'TotalSegments' segments,
+                         read in parallel. items come out in no order.
+        @param max_workers: segments read at the same time, all by default
+        @param queue_size: pages read ahead of the consumer
+        @param options: extra 'Table.scan' arguments
+
+        closing the generator early stops the segment readers.
+        """
+        if filter_expression is not None:
+            options['FilterExpression'] = filter_expression
+        self._read_options(projection, page_size, options)
+
+        if segments <= 1:
+            table = self.resource.Table(table_name)
+            for items in self._pages(table.scan, options):
+                for item in items:
+                    yield item
+            return
+
+        import boto3
+
+        local = threading.local()
+
+        def read_segment(segment, emit):
+            # boto3 resources are not thread safe: one per thread
+            if getattr(local, 'table', None) is None:
+                local.table = self._resource(boto3.session.Session()).Table(table_name)
+
+            segment_options = dict(options, Segment=segment, TotalSegments=segments)
+            for items in self._pages(local.table.scan, segment_options):
+                if not emit(items):
+                    return
+
+        producers = [functools.partial(read_segment, segment) for segment in range(segments)]
+        for items in merge_threads(producers, queue_size, max_workers or segments,
+                                   thread_name_prefix='dynamodb_scan'):
+            for item in items:
+                yield item
 
 
 ## elasticsearch
@@ -185,11 +786,14 @@ class dynamodb_handler(object):
 class elasticsearch_handler(object):
 
     def __init__(self):
+        from elasticsearch import Elasticsearch, RequestsHttpConnection
 
         if cfg.APP_ENV == 'local':
             self.client = Elasticsearch()
 
         else:
+            from requests_aws4auth import AWS4Auth
+
             awsauth = AWS4Auth(cfg.AWS_ACCESS_KEY_ID,
                                cfg.AWS_SECRET_ACCESS_KEY,
                                cfg.AWS_REGION_NAME,
@@ -211,6 +815,21 @@ class elasticsearch_handler(object):
         
         return reponse
 
+    def bulk_indexer(self, index_name, **options):
+        """
+        '_bulk' version of 'save_document', see 'elastic.BulkIndexer'.
+        """
+        return BulkIndexer(self.client, index_name, **options)
+
+    def search(self, index_name, query=None, source=None, page_size=1000, **options):
+        """
+        yields every hit of 'query' in pages, see 'elastic.search_pages'.
+
+            for hits in es.search('evaluations', query, source=['lead', 'decision'], slices=4):
+                ...
+        """
+        return search_pages(self.client, index_name, query, source, page_size, **options)
+
 # ---- utils
 
 # Helper class to convert a DynamoDB item to JSON. #
@@ -223,8 +842,28 @@ class DecimalEncoder(json.JSONEncoder):
 
 # Atenea
 
-def get_policy(policy_version):
+def _read_policy(version, variation):
+    from boto3.dynamodb.conditions import Key
+
+    table_name = os.environ.get('API_DDB_POLICY_TBL', '')
+
+    dy = dynamodb_handler()
+    table = dy.resource.Table(table_name)
+    response = table.query(
+        KeyConditionExpression=Key('version_id').eq(version) & \
+                               Key('sub_version_id').eq(variation))
+    return response['Items'][0]
+
+# process-wide cache of the policies, see 'policy.PolicyCache'
+policy_cache = PolicyCache(_read_policy)
+
+def get_policy(policy_version, cached=True):
     """
+    @param cached: True copies the policy kept by 'policy_cache' (read from
+                   dynamodb the first time), False reads it from dynamodb
+    @return: a mutable policy (dicts and lists), as it always was. read-only
+             code can take the shared frozen one from 'policy_cache.get'
+             and skip the copy.
     @raise: ValueError
 
     TODO: 
@@ -232,30 +871,20 @@ def get_policy(policy_version):
         - implementar get_document 'dynamodb_handler'
         - integrar a 'RiskEngine'
     """
-    table_name = os.environ.get('API_DDB_POLICY_TBL', '')
-
     try:
-        version = int(policy_version.rsplit('.')[0])
-        variation = int(policy_version.rsplit('.')[1])
+        version, variation = parse_version(policy_version)
     except ValueError as err:
         msg = { 'message': 'error getting policy', 'error': err }
         raise ValueError(msg)
 
     try:
-        dy = dynamodb_handler()
-        table = dy.resource.Table(table_name)
-        response = table.query(
-            KeyConditionExpression=Key('version_id').eq(version) & \
-                                   Key('sub_version_id').eq(variation))
-        raw_policy = json.dumps(response['Items'][0], cls=DecimalEncoder)
-        raw_policy = raw_policy.replace('"false"', '"False"')
-        raw_policy = raw_policy.replace('"true"', '"True"')
+        if cached:
+            return thaw(policy_cache.get(policy_version))
+        return normalize(_read_policy(version, variation))
     except BaseException as err:
         msg = { 'message': 'error getting policy', 'error': err }
         raise ValueError(msg)
 
-    return json.loads(raw_policy)
-
 def put_policy(policy, policy_version, start_node=0, force=False):
 
     # force to update
@@ -283,6 +912,10 @@ def put_policy(policy, policy_version, start_node=0, force=False):
     }
 
     dy = dynamodb_handler()
-    return dy.save_document(raw_doc=doc,
-                            table_name=table_name)
+    response = dy.save_document(raw_doc=doc,
+                                table_name=table_name)
+
+    # a forced put replaces the cached version
+    policy_cache.invalidate(policy_version)
+    return response
     
\ No newline at end of file
@@ -5,12 +5,11 @@ database settings file
 """
 import os
 
-from dotenv import load_dotenv, find_dotenv
+from ..client.env import load_env
 
 # ----
 
-dotenv_path = find_dotenv() 
-load_dotenv(dotenv_path)
+load_env()
 
 # ----
 
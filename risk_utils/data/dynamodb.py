@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+dynamodb module
+
+python values straight to dynamodb attribute values, and a batched,
+background writer on top of 'BatchWriteItem'.
+"""
+import math
+import os
+import random
+import time
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from ..client.batch import run_many, BackgroundFlusher
+
+# ---- serializer
+
+def serialize(value):
+    """
+    dynamodb attribute value of 'value', same format 'save_document' wrote
+    through dynamodb_json: empty strings and None are NULL, datetimes
+    '%Y-%m-%dT%H:%M:%S.%f' strings, dates '%Y-%m-%d', uuids their hex, and
+    sets / tuples lists. bytes are stored as B.
+    """
+    if value is None:
+        return { 'NULL': True }
+    if isinstance(value, str):
+        return { 'S': value } if value else { 'NULL': True }
+    # bool before int, bool is an int
+    if isinstance(value, bool):
+        return { 'BOOL': value }
+    if isinstance(value, int):
+        return { 'N': str(value) }
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise TypeError('dynamodb does not store %r' % value)
+        return { 'N': repr(value) }
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            raise TypeError('dynamodb does not store %r' % value)
+        return { 'N': str(value) }
+    if isinstance(value, dict):
+        return { 'M': to_item(value) }
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return { 'L': [serialize(item) for item in value] }
+    if isinstance(value, datetime):
+        return { 'S': value.strftime('%Y-%m-%dT%H:%M:%S.%f') }
+    if isinstance(value, date):
+        return { 'S': value.strftime('%Y-%m-%d') }
+    if isinstance(value, uuid.UUID):
+        return { 'S': value.hex }
+    if isinstance(value, (bytes, bytearray)):
+        return { 'B': bytes(value) }
+
+    raise TypeError('unsupported type for dynamodb: %s' % type(value).__name__)
+
+def to_item(doc):
+    """
+    dynamodb item (attribute name -> attribute value) of the dict 'doc'.
+    """
+    return dict((key if isinstance(key, str) else str(key), serialize(value))
+                for key, value in doc.items())
+
+# ---- batch writer
+
+BATCH_SIZE = 25 # BatchWriteItem limit
+
+DYNAMODB_FLUSH_INTERVAL = float(os.environ.get('DYNAMODB_FLUSH_INTERVAL', 1))
+DYNAMODB_MAX_PENDING = int(os.environ.get('DYNAMODB_MAX_PENDING', 10000))
+
+# error codes worth retrying, besides 5xx and connection errors
+RETRY_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+               'RequestLimitExceeded', 'InternalServerError', 'ServiceUnavailable')
+
+def is_retryable(error):
+    """
+    True for the throttling, 5xx and connection errors of a boto3 call,
+    False for the ones a retry can't fix (ValidationException...).
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code') in RETRY_CODES:
+            return True
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        from botocore.exceptions import ConnectionError as EndpointError, HTTPClientError
+    except ImportError:
+        return False
+    # EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError...
+    return isinstance(error, (EndpointError, HTTPClientError))
+
+class BatchWriter(BackgroundFlusher):
+    """
+    buffers 'put' documents and writes them with BatchWriteItem, 25 items a
+    call, from a background thread.
+
+    @param client: boto3 dynamodb client
+    @param flush_interval: max secs a document waits in the buffer
+    @param max_pending: buffered documents before 'put' blocks
+    @param concurrency: BatchWriteItem calls in flight per flush
+    @param max_attempts: attempts per batch on throttling, 5xx and
+                         connection errors, unprocessed items included
+    @param backoff: first retry delay in secs, doubled up to 'max_backoff'
+    @param on_error: called as on_error(items, error) with the items given
+                     up on. defaults to printing the error.
+
+    items of the same batch must not share their key, dynamodb rejects
+    the whole call.
+
+        with dynamodb_handler().batch_writer('evaluations') as writer:
+            writer.put(doc)
+    """
+
+    THREAD_NAME = 'dynamodb-writer'
+    FULL_ERROR = 'DYNAMODB_WRITER_FULL'
+    CLOSED_ERROR = 'DYNAMODB_WRITER_CLOSED'
+
+    class Error(BackgroundFlusher.Error):
+        pass
+
+    def __init__(self, client, table_name,
+                 flush_interval=DYNAMODB_FLUSH_INTERVAL,
+                 max_pending=DYNAMODB_MAX_PENDING,
+                 concurrency=4,
+                 max_attempts=8,
+                 backoff=0.05,
+                 max_backoff=5,
+                 on_error=None):
+        super(BatchWriter, self).__init__(flush_interval, max_pending)
+        self.client = client
+        self.table_name = table_name
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_error = on_error
+
+        self.written = 0
+        self.failed = 0
+
+    # ---- producer
+
+    def put(self, doc, timeout=None):
+        """
+        serializes 'doc' and buffers it. blocks while 'max_pending'
+        documents are waiting.
+        @raise: TypeError if 'doc' can't be stored, BatchWriter.Error if
+                closed or still full after 'timeout' secs
+        """
+        self.put_item(to_item(doc), timeout)
+
+    def put_item(self, item, timeout=None):
+        """
+        'put' of an already serialized item.
+        """
+        self._put(item, timeout)
+
+    # ---- consumer
+
+    def _write(self, items):
+        """
+        writes one batch, retrying throttling, 5xx and connection errors and
+        the unprocessed items with exponential backoff and jitter.
+        """
+        requests = [{ 'PutRequest': { 'Item': item } } for item in items]
+        error = None
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                time.sleep(delay * random.uniform(0.5, 1))
+
+            try:
+                response = self.client.batch_write_item(
+                    RequestItems={ self.table_name: requests })
+            except Exception as err:
+                error = err
+                if is_retryable(err):
+                    continue
+                # e.g. duplicated keys in the batch: the same call fails again
+                break
+
+            written = len(requests)
+            requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            with self._condition:
+                self.written += written - len(requests)
+            if not requests:
+                return
+            error = self.Error('UNPROCESSED_ITEMS - %s' % len(requests))
+
+        with self._condition:
+            self.failed += len(requests)
+        failed_items = [request['PutRequest']['Item'] for request in requests]
+        if self.on_error is not None:
+            self.on_error(failed_items, error)
+        else:
+            print('dynamodb writer error: %s items to %s not written - %s'
+                  % (len(failed_items), self.table_name, error))
+
+    def _is_full(self):
+        return len(self._pending) >= BATCH_SIZE
+
+    def _pop_pending(self):
+
+        limit = min(self.concurrency * BATCH_SIZE, len(self._pending))
+        return [self._pending.popleft() for _ in range(limit)]
+
+    def _send_pending(self, items):
+
+        batches = [items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)]
+        for item in run_many(self._write, batches, self.concurrency):
+            if item['error'] is not None:
+                # only on_error itself can raise here
+                print('dynamodb writer error: %s' % item['error'])
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+elastic module
+
+'_bulk' indexer for 'elasticsearch_handler': documents are sent in batches
+bounded by count and size, several requests in flight, either from an
+iterator or from a background thread.
+
+'search_pages' reads a whole query with search_after over a point in time,
+or with a scroll where there is none, optionally in slices read by parallel
+threads.
+"""
+import functools
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+from ..client.batch import run_many, merge_threads, BackgroundFlusher
+
+# ---- bulk indexer
+
+ES_BULK_MAX_DOCS = int(os.environ.get('ES_BULK_MAX_DOCS', 500))
+ES_BULK_MAX_BYTES = int(os.environ.get('ES_BULK_MAX_BYTES', 5 * 1024 * 1024))
+ES_FLUSH_INTERVAL = float(os.environ.get('ES_FLUSH_INTERVAL', 1))
+ES_MAX_PENDING = int(os.environ.get('ES_MAX_PENDING', 10000))
+
+# request / item statuses worth retrying ('N/A' is a connection error)
+RETRY_STATUSES = (429, 502, 503, 504, 'N/A')
+
+class BulkIndexer(BackgroundFlusher):
+    """
+    @param client: elasticsearch client
+    @param max_docs: documents per '_bulk' request
+    @param max_bytes: body bytes per '_bulk' request
+    @param concurrency: requests in flight
+    @param max_attempts: attempts per request, rejected (429) items included
+    @param backoff: first retry delay in secs, doubled up to 'max_backoff'
+    @param id_field: document field used as '_id', auto ids if None
+    @param flush_interval: background mode, max secs a document waits
+    @param max_pending: background mode, buffered documents before 'put'
+                        blocks
+    @param on_error: background mode, called as on_error(errors) with
+                     [{ 'doc', 'error', 'retryable' }] of the documents
+                     given up on ('retryable': still failing with 429 /
+                     5xx / connection errors after 'max_attempts').
+                     defaults to printing them.
+
+    from an iterator:
+
+        result = es.bulk_indexer('evaluations').index_many(docs)
+
+    or in the background:
+
+        with es.bulk_indexer('evaluations') as indexer:
+            indexer.put(doc)
+    """
+
+    THREAD_NAME = 'es-indexer'
+    FULL_ERROR = 'ES_INDEXER_FULL'
+    CLOSED_ERROR = 'ES_INDEXER_CLOSED'
+
+    class Error(BackgroundFlusher.Error):
+        pass
+
+    def __init__(self, client, index_name,
+                 max_docs=ES_BULK_MAX_DOCS,
+                 max_bytes=ES_BULK_MAX_BYTES,
+                 concurrency=4,
+                 max_attempts=8,
+                 backoff=0.5,
+                 max_backoff=30,
+                 id_field=None,
+                 flush_interval=ES_FLUSH_INTERVAL,
+                 max_pending=ES_MAX_PENDING,
+                 on_error=None):
+        super(BulkIndexer, self).__init__(flush_interval, max_pending)
+        self.client = client
+        self.index_name = index_name
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.id_field = id_field
+        self.on_error = on_error
+
+        self.indexed = 0
+        self.failed = 0
+
+        # '_pending' holds (doc, encoded action + source)
+        self._pending_bytes = 0
+
+    # ---- encoding
+
+    def _encode(self, doc):
+
+        action = { '_index': self.index_name, '_type': '_doc' }
+        if self.id_field is not None:
+            action['_id'] = doc[self.id_field]
+
+        # the client's serializer: same datetime / decimal handling as 'index'
+        source = self.client.transport.serializer.dumps(doc)
+        return ('%s\n%s\n' % (json.dumps({ 'index': action }), source)).encode('utf-8')
+
+    def _batches(self, lines):
+        """
+        groups the encoded (doc, line) pairs in batches within 'max_docs'
+        and 'max_bytes'. a document bigger than 'max_bytes' goes alone.
+        """
+        batch, size = [], 0
+        for doc, line in lines:
+            if batch and (len(batch) >= self.max_docs or size + len(line) > self.max_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append((doc, line))
+            size += len(line)
+
+        if batch:
+            yield batch
+
+    # ---- sender
+
+    def _send(self, batch):
+        """
+        sends one '_bulk' request, retrying the whole request on 429 / 5xx /
+        connection errors and the items rejected with 429.
+        @return: (indexed, [{ 'doc', 'error', 'retryable' }])
+        """
+        indexed, errors, error = 0, [], None
+
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                time.sleep(delay * random.uniform(0.5, 1))
+
+            try:
+                response = self.client.bulk(body=b''.join(line for _, line in batch))
+            except Exception as err:
+                if getattr(err, 'status_code', None) in RETRY_STATUSES:
+                    error = err
+                    continue
+                return indexed, errors + [{ 'doc': doc, 'error': str(err), 'retryable': False }
+                                          for doc, _ in batch]
+
+            retry = []
+            for (doc, line), item in zip(batch, response['items']):
+                result = next(iter(item.values()))
+                status = result.get('status')
+                if status in RETRY_STATUSES:
+                    retry.append((doc, line))
+                    error = result.get('error')
+                elif status >= 300:
+                    errors.append({ 'doc': doc, 'error': result.get('error'), 'retryable': False })
+                else:
+                    indexed += 1
+
+            if not retry:
+                return indexed, errors
+            batch = retry
+
+        return indexed, errors + [{ 'doc': doc, 'error': str(error), 'retryable': True }
+                                  for doc, _ in batch]
+
+    def index_many(self, docs):
+        """
+        indexes every document of the iterable 'docs' (consumed lazily).
+        @return: { 'indexed', 'failed', 'errors': [{ 'doc', 'error', 'retryable' }],
+                   'response_time', 'docs_per_second' }
+        """
+        t0 = datetime.now()
+        indexed, errors = 0, []
+
+        lines = ((doc, self._encode(doc)) for doc in docs)
+        for item in run_many(self._send, self._batches(lines), self.concurrency):
+            if item['error'] is not None:
+                raise self.Error('BULK_ERROR - %s' % item['error'])
+            batch_indexed, batch_errors = item['result']
+            indexed += batch_indexed
+            errors.extend(batch_errors)
+
+        t1 = datetime.now()
+        with self._condition:
+            self.indexed += indexed
+            self.failed += len(errors)
+
+        secs = (t1 - t0).total_seconds()
+        return  {
+                    'indexed': indexed,
+                    'failed': len(errors),
+                    'errors': errors,
+                    'response_time': t1 - t0,
+                    'docs_per_second': indexed / secs if secs else None
+                }
+
+    # ---- background mode
+
+    def put(self, doc, timeout=None):
+        """
+        encodes 'doc' and buffers it for the background flusher. blocks
+        while 'max_pending' documents are waiting.
+        @raise: BulkIndexer.Error if closed or still full after 'timeout'
+                secs
+        """
+        self._put((doc, self._encode(doc)), timeout)
+
+    def _append(self, item):
+
+        self._pending.append(item)
+        self._pending_bytes += len(item[1])
+
+    def _is_full(self):
+        return len(self._pending) >= self.max_docs or self._pending_bytes >= self.max_bytes
+
+    def _pop_pending(self):
+
+        docs = list(self._pending)
+        self._pending.clear()
+        self._pending_bytes = 0
+        return docs
+
+    def _send_pending(self, docs):
+
+        for item in run_many(self._send, self._batches(docs), self.concurrency):
+            if item['error'] is not None:
+                print('es indexer error: %s' % item['error'])
+                continue
+            indexed, errors = item['result']
+            with self._condition:
+                self.indexed += indexed
+                self.failed += len(errors)
+            if errors:
+                if self.on_error is not None:
+                    self.on_error(errors)
+                else:
+                    print('es indexer error: %s documents to %s not indexed - %s'
+                          % (len(errors), self.index_name, errors[0]['error']))
+
+# ---- reader
+
+def _pit_pages(client, body, pit_id, keep_alive):
+    """
+    yields the hits of one slice of a point in time page by page, following
+    'search_after'.
+    """
+    body = dict(body)
+    while True:
+        body['pit'] = { 'id': pit_id, 'keep_alive': keep_alive }
+        response = client.search(body=body)
+        # the id can change between searches
+        pit_id = response.get('pit_id', pit_id)
+
+        hits = response['hits']['hits']
+        if hits:
+            yield hits
+        if len(hits) < body['size']:
+            return
+        body['search_after'] = hits[-1]['sort']
+
+def _scroll_pages(client, body, index_name, keep_alive):
+    """
+    yields the hits of one slice of a scroll page by page, and clears the
+    scroll.
+    """
+    response = client.search(index=index_name, body=body, scroll=keep_alive)
+    scroll_id = response.get('_scroll_id')
+    try:
+        while True:
+            hits = response['hits']['hits']
+            if not hits:
+                return
+            yield hits
+            response = client.scroll(body={ 'scroll_id': scroll_id, 'scroll': keep_alive })
+            scroll_id = response.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id is not None:
+            try:
+                client.clear_scroll(body={ 'scroll_id': scroll_id })
+            except Exception:
+                # expires after 'keep_alive' anyway
+                pass
+
+def _open_point_in_time(client, index_name, keep_alive, required):
+    """
+    id of a new point in time, None if the cluster has none (< 7.10, aws
+    elasticsearch domains) and it is not 'required'.
+    """
+    try:
+        return client.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+    except Exception as err:
+        # old clients lack the method, old clusters reject '_pit'
+        unsupported = (isinstance(err, AttributeError)
+                       or getattr(err, 'status_code', None) in (400, 404, 405))
+        if required or not unsupported:
+            raise
+        return None
+
+def search_pages(client, index_name, query=None, source=None, page_size=1000,
+                 sort=None, slices=1, point_in_time=None, keep_alive='5m',
+                 max_workers=None, queue_size=10):
+    """
+    yields every hit of 'query' on 'index_name' in pages (lists of hits),
+    without the from / size result window limit.
+
+    @param source: '_source' filter, a list of fields or { includes, excludes }
+    @param sort: unique sort for 'search_after'. defaults to '_shard_doc'
+                 with a point in time (which needs 7.12, give one on 7.10 /
+                 7.11) and to '_doc' with a scroll.
+    @param slices: > 1 splits the read in slices read by parallel threads,
+                   pages come out in no order
+    @param point_in_time: True requires a point in time (7.10+), False reads
+                          with a (sliced) scroll, None (default) uses a point
+                          in time when the cluster has one and a scroll
+                          otherwise, e.g. on aws elasticsearch domains
+    @param keep_alive: lifetime of the point in time / scroll between pages
+    @param max_workers: slices read at the same time, all by default
+    @param queue_size: pages read ahead of the consumer
+
+    closing the generator early stops the slice readers and closes the
+    point in time or the scrolls.
+    """
+    pit_id = None
+    if point_in_time is not False:
+        pit_id = _open_point_in_time(client, index_name, keep_alive, point_in_time)
+
+    if pit_id is not None:
+        body = { 'size': page_size, 'sort': sort or ['_shard_doc'], 'track_total_hits': False }
+    else:
+        body = { 'size': page_size, 'sort': sort or ['_doc'] }
+    if query is not None:
+        body['query'] = query
+    if source is not None:
+        body['_source'] = source
+
+    def read(body):
+        if pit_id is not None:
+            return _pit_pages(client, body, pit_id, keep_alive)
+        return _scroll_pages(client, body, index_name, keep_alive)
+
+    try:
+        if slices <= 1:
+            for hits in read(body):
+                yield hits
+            return
+
+        def read_slice(slice_id, emit):
+            slice_body = dict(body, slice={ 'id': slice_id, 'max': slices })
+            for hits in read(slice_body):
+                if not emit(hits):
+                    return
+
+        producers = [functools.partial(read_slice, slice_id) for slice_id in range(slices)]
+        for hits in merge_threads(producers, queue_size, max_workers or slices,
+                                  thread_name_prefix='es_slice'):
+            yield hits
+
+    finally:
+        if pit_id is not None:
+            try:
+                client.close_point_in_time(body={ 'id': pit_id })
+            except Exception:
+                # expires after 'keep_alive' anyway
+                pass
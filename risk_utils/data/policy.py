@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+policy module
+
+in-process cache of the parsed policies read by 'get_policy'. a policy
+version never changes once written, so it is read from dynamodb once per
+process (or once per deploy with a snapshot file).
+"""
+import json
+import os
+import tempfile
+import threading
+from decimal import Decimal
+
+from ..client.batch import run_many
+from ..client.singleflight import SingleFlight
+
+# ----
+
+# comma separated versions loaded by 'warm_up', e.g. '12.0,12.1'
+POLICY_ACTIVE_VERSIONS = os.environ.get('POLICY_ACTIVE_VERSIONS', '')
+POLICY_SNAPSHOT_PATH = os.environ.get('POLICY_SNAPSHOT_PATH')
+
+# ---- parsing
+
+def parse_version(policy_version):
+    """
+    '12.1' -> (12, 1)
+    @raise: ValueError
+    """
+    version, variation = policy_version.rsplit('.')[:2]
+    return int(version), int(variation)
+
+def _text(value):
+    # the policies store booleans as 'True' / 'False' strings
+    if value == 'true':
+        return 'True'
+    if value == 'false':
+        return 'False'
+    return value
+
+def normalize(value):
+    """
+    dynamodb policy item to plain values, as 'get_policy' always returned
+    them: numbers (Decimal) as strings and 'true' / 'false' strings, keys
+    included, as 'True' / 'False'.
+    @raise: TypeError for values without a json form (sets, binary)
+    """
+    if isinstance(value, dict):
+        return dict((_text(key), normalize(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, str):
+        return _text(value)
+    if isinstance(value, Decimal):
+        return str(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+# ---- immutable structures
+
+class FrozenDict(dict):
+    """
+    read-only dict. it is still a dict, so json.dumps and isinstance
+    checks work; 'thaw' gives a mutable copy.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('cached policies are read-only, use thaw() for a copy')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+def freeze(value):
+    """
+    dicts to 'FrozenDict' and lists to tuples, recursively.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    """
+    mutable copy of a frozen policy.
+    """
+    if isinstance(value, dict):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+# ---- cache
+
+class PolicyCache(object):
+    """
+    @param loader: function (version, variation) -> raw policy item
+    @param snapshot_path: json file with the cached policies, read on first
+                          use and written by 'save_snapshot'
+
+    policies are kept forever (versions are immutable); 'invalidate' drops
+    one after a forced 'put_policy'. concurrent misses of the same version
+    share one read.
+    """
+
+    def __init__(self, loader, snapshot_path=POLICY_SNAPSHOT_PATH):
+        self.loader = loader
+        self.snapshot_path = snapshot_path
+
+        self._policies = {} # (version, variation) -> frozen policy
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._snapshot_loaded = snapshot_path is None
+
+    def _load(self, key):
+
+        policy = freeze(normalize(self.loader(*key)))
+        with self._lock:
+            self._policies[key] = policy
+        return policy
+
+    def get(self, policy_version):
+        """
+        @return: the frozen policy of 'policy_version' ('12.1')
+        @raise: ValueError for a malformed version, the loader errors
+        """
+        if not self._snapshot_loaded:
+            self.load_snapshot()
+
+        key = parse_version(policy_version)
+        policy = self._policies.get(key)
+        if policy is None:
+            policy = self._flight.do(key, lambda: self._load(key))
+        return policy
+
+    def warm_up(self, policy_versions=None, concurrency=4):
+        """
+        loads 'policy_versions' (default $POLICY_ACTIVE_VERSIONS) in
+        parallel, meant for worker start.
+        @return: { policy_version: error } of the ones that failed
+        """
+        if policy_versions is None:
+            policy_versions = [version.strip() for version in POLICY_ACTIVE_VERSIONS.split(',')
+                               if version.strip()]
+        policy_versions = list(policy_versions)
+
+        errors = {}
+        for item in run_many(self.get, policy_versions, concurrency):
+            if item['error'] is not None:
+                errors[policy_versions[item['index']]] = item['error']
+        return errors
+
+    def invalidate(self, policy_version=None):
+        """
+        drops one version, or all of them.
+        """
+        with self._lock:
+            if policy_version is None:
+                self._policies.clear()
+            else:
+                self._policies.pop(parse_version(policy_version), None)
+
+    def versions(self):
+        return sorted('%s.%s' % key for key in self._policies)
+
+    # ---- snapshot
+
+    def load_snapshot(self, path=None):
+        """
+        adds the policies of a snapshot file. a missing or broken file is
+        ignored, policies are then read from dynamodb.
+        @return: number of policies loaded
+        """
+        path = path or self.snapshot_path
+        self._snapshot_loaded = True
+        if not path:
+            return 0
+
+        try:
+            with open(path, encoding='utf-8') as snapshot:
+                policies = json.load(snapshot)
+        except (OSError, ValueError) as err:
+            if not isinstance(err, FileNotFoundError):
+                print('policy snapshot %s not loaded: %s' % (path, err))
+            return 0
+
+        with self._lock:
+            for policy_version, policy in policies.items():
+                self._policies.setdefault(parse_version(policy_version), freeze(policy))
+        return len(policies)
+
+    def save_snapshot(self, path=None):
+        """
+        writes every cached policy to 'path' (atomically).
+        """
+        path = path or self.snapshot_path
+        if not path:
+            raise ValueError('no snapshot path')
+
+        with self._lock:
+            policies = dict(('%s.%s' % key, policy) for key, policy in self._policies.items())
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.policies-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as snapshot:
+                json.dump(policies, snapshot)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __len__(self):
+        return len(self._policies)
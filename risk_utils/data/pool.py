@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+pool module
+
+process-wide connection pools for the sql handlers, one per
+(engine, server, database) entry of db_settings.
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# ----
+
+POOL_MINSIZE = int(os.environ.get('DB_POOL_MINSIZE', 0))
+POOL_MAXSIZE = int(os.environ.get('DB_POOL_MAXSIZE', 10))
+# secs a connection may stay idle before it is closed
+POOL_IDLE_TIMEOUT = int(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300))
+# secs to wait for a free connection when the pool is full
+POOL_CHECKOUT_TIMEOUT = int(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 30))
+
+# ----
+
+class ConnectionPool(object):
+    """
+    @param connect: function that opens a new dbapi connection
+    @param ping: function that raises if a connection is no longer usable,
+                 called before a connection is handed out
+    @param minsize: connections kept open even when idle
+    @param maxsize: max connections open at the same time
+    @param idle_timeout: idle secs after which extra connections are closed
+    @param checkout_timeout: secs to wait for a connection when all of them
+                             are in use
+    """
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, connect, ping,
+                 minsize=POOL_MINSIZE,
+                 maxsize=POOL_MAXSIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT):
+
+        if maxsize < 1 or minsize > maxsize:
+            raise ValueError('invalid pool size: min %s, max %s' % (minsize, maxsize))
+
+        self._connect = connect
+        self._ping = ping
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = deque() # (connection, released_at)
+        self._size = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        for _ in range(minsize):
+            self._idle.append((self._open(), time.time()))
+
+    def _open(self):
+
+        connection = self._connect()
+        with self._condition:
+            self._size += 1
+        return connection
+
+    def _discard(self, connection):
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _is_healthy(self, connection):
+
+        try:
+            self._ping(connection)
+            return True
+        except Exception:
+            return False
+
+    def _take_expired(self):
+
+        # the oldest idle connections are on the left: handing out from the
+        # right never reaches them, so they are closed here. call with the
+        # condition held, close the returned ones without it
+        expired = []
+        limit = time.time() - self.idle_timeout
+        while (self._idle and self._idle[0][1] < limit
+               and self._size - len(expired) > self.minsize):
+            expired.append(self._idle.popleft()[0])
+        return expired
+
+    def _reap(self):
+
+        with self._condition:
+            expired = self._take_expired()
+        for connection in expired:
+            self._discard(connection)
+
+    def acquire(self, timeout=None):
+        """
+        checks out a healthy connection, opening one if needed.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+
+        self._reap()
+        while True:
+            connection = None
+            with self._condition:
+                while not self._idle and self._size >= self.maxsize:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise self.Error('POOL_TIMEOUT - no free connection after %s secs' % timeout)
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    # most recently used first, so the extra ones go idle
+                    connection, released_at = self._idle.pop()
+                    expired = (time.time() - released_at > self.idle_timeout
+                               and self._size > self.minsize)
+                else:
+                    self._size += 1
+
+            if connection is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+            if expired or not self._is_healthy(connection):
+                self._discard(connection)
+                continue
+
+            return connection
+
+    def release(self, connection, discard=False):
+        """
+        returns a connection to the pool. any open transaction is rolled back.
+        once the pool is closed the connection is closed instead.
+        """
+        if not discard:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        if not discard:
+            with self._condition:
+                # a closed pool takes nothing back
+                discard = self._closed
+                if not discard:
+                    self._idle.append((connection, time.time()))
+                    self._condition.notify()
+
+        if discard:
+            return self._discard(connection)
+        self._reap()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        with pool.connection() as connection: ...
+        """
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close(self):
+        """
+        closes the idle connections, the ones checked out are closed when
+        they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+
+        for connection, _ in idle:
+            self._discard(connection)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+# ----
+
+_pools = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+
+def get_pool(key, connect, ping, **options):
+    """
+    returns the process-wide pool for 'key', created on first use with
+    'connect', 'ping' and the 'ConnectionPool' options. after a fork the
+    child process gets new pools.
+
+    later calls may leave the options out; options given again must match
+    the ones of the existing pool.
+    @raise: ValueError on options that differ from the existing pool's
+    """
+    global _pools_pid
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, ping, **options)
+            return pool
+
+    conflicts = ['%s=%r (pool has %r)' % (name, value, getattr(pool, name))
+                 for name, value in sorted(options.items()) if getattr(pool, name) != value]
+    if conflicts:
+        raise ValueError('pool %s already exists with other options: %s'
+                         % (key, ', '.join(conflicts)))
+    return pool
+
+def close_pools():
+    """
+    closes the idle connections of every pool of the process.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+engine module
+
+'RiskEngine': a policy of 'get_policy' compiled once into flat node arrays
+with precompiled predicates, evaluated for one lead (the merged features of
+'enrich_lead') or, vectorized with numpy, for a whole batch of leads.
+
+policy format: 'policy' holds the nodes, keyed by node id (or a list, the
+position is the id). a node is either a rule
+
+    { 'condition': "bcra_situation_current > 2 or is_in_blacklist",
+      'True': '1', 'False': '2' }
+
+whose condition is a python expression over the feature names and whose
+'True' / 'False' keys ('get_policy' turns 'true' / 'false' into them) are
+the next nodes, or a leaf
+
+    { 'decision': 'REJECTED', ... }
+
+'start_node' is the first node.
+"""
+import ast
+import copy
+import functools
+from datetime import datetime
+
+# ---- predicates
+
+_ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+                  ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+                  ast.FloorDiv, ast.Mod, ast.Pow, ast.Compare, ast.Eq, ast.NotEq, ast.Lt,
+                  ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+                  ast.Name, ast.Load, ast.Constant, ast.Tuple, ast.List, ast.Set)
+
+def _parse(condition):
+    """
+    @return: (expression ast, feature names)
+    @raise: ValueError for syntax errors or anything but operators,
+            feature names and literals
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode='eval')
+    except SyntaxError as err:
+        raise ValueError('invalid condition %r: %s' % (condition, err))
+
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError('invalid condition %r: %s not allowed'
+                             % (condition, type(node).__name__))
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+
+    return tree, names
+
+class _Features(ast.NodeTransformer):
+    # feature name -> f['name']
+
+    def visit_Name(self, node):
+        return ast.copy_location(
+            ast.Subscript(value=ast.Name(id='f', ctx=ast.Load()),
+                          slice=ast.Constant(value=node.id),
+                          ctx=ast.Load()), node)
+
+class _Vectorize(_Features):
+    # python boolean logic -> elementwise numpy logic
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = '_and' if isinstance(node.op, ast.And) else '_or'
+        return ast.copy_location(ast.Call(func=ast.Name(id=func, ctx=ast.Load()),
+                                          args=node.values, keywords=[]), node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.Call(func=ast.Name(id='_not', ctx=ast.Load()),
+                                              args=[node.operand], keywords=[]), node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        # a < b < c -> _and(a < b, b < c)
+        terms, left = [], node.left
+        for op, right in zip(node.ops, node.comparators):
+            terms.append(self._compare(left, op, right))
+            left = right
+        if len(terms) == 1:
+            return ast.copy_location(terms[0], node)
+        return ast.copy_location(ast.Call(func=ast.Name(id='_and', ctx=ast.Load()),
+                                          args=terms, keywords=[]), node)
+
+    def _compare(self, left, op, right):
+
+        def call(func, *args):
+            return ast.Call(func=ast.Name(id=func, ctx=ast.Load()), args=list(args), keywords=[])
+
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+                raise ValueError('"in" needs a literal collection to vectorize')
+            values = ast.List(elts=right.elts, ctx=ast.Load())
+            return call('_isin' if isinstance(op, ast.In) else '_notin', left, values)
+
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            if not (isinstance(right, ast.Constant) and right.value is None):
+                raise ValueError('"is" only vectorizes against None')
+            return call('_isnone' if isinstance(op, ast.Is) else '_notnone', left)
+
+        return ast.Compare(left=left, ops=[op], comparators=[right])
+
+def _compile(tree, transformer, namespace, label):
+
+    tree = transformer.visit(copy.deepcopy(tree))
+    body = ast.Expression(body=ast.Lambda(
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(arg='f')], kwonlyargs=[],
+                           kw_defaults=[], defaults=[]),
+        body=tree.body))
+    ast.fix_missing_locations(body)
+    return eval(compile(body, label, 'eval'), namespace)
+
+def _vector_namespace():
+    import numpy as np
+
+    def is_none(values):
+        return np.frompyfunc(lambda value: value is None, 1, 1)(values).astype(bool)
+
+    return {
+        '__builtins__': {},
+        '_and': lambda *values: functools.reduce(np.logical_and, values),
+        '_or': lambda *values: functools.reduce(np.logical_or, values),
+        '_not': np.logical_not,
+        '_isin': lambda values, options: np.isin(values, options),
+        '_notin': lambda values, options: ~np.isin(values, options),
+        '_isnone': is_none,
+        '_notnone': lambda values: ~is_none(values)
+    }
+
+# ---- engine
+
+class RiskEngine(object):
+    """
+    @param policy: a 'get_policy' item ({ 'policy', 'start_node', ... }) or
+                   just its nodes
+    @param start_node: first node id, defaults to the item's 'start_node'
+
+        engine = RiskEngine.from_version('12.1')
+        engine.evaluate(enrich_lead(lead)['data'])
+        engine.evaluate_batch({ 'bcra_situation_current': [...], ... })
+    """
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, policy, start_node=None):
+
+        if isinstance(policy, dict) and 'policy' in policy:
+            if start_node is None:
+                start_node = policy.get('start_node')
+            nodes = policy['policy']
+        else:
+            nodes = policy
+
+        if isinstance(nodes, dict):
+            items = [(str(node_id), node) for node_id, node in nodes.items()]
+        else:
+            items = [(str(node.get('id', position)), node) for position, node in enumerate(nodes)]
+
+        if not items:
+            raise self.Error('empty policy')
+        start_node = str(items[0][0] if start_node is None else start_node)
+
+        self._compile(items, start_node)
+
+    @classmethod
+    def from_version(cls, policy_version):
+        """
+        engine of a 'get_policy' version ('12.1'), read through the policy
+        cache (the frozen policy, not a copy).
+        """
+        from ..data.data import policy_cache
+
+        return cls(policy_cache.get(policy_version))
+
+    # ---- compile
+
+    def _compile(self, items, start_node):
+        """
+        flat arrays indexed by node position: 'is_leaf', 'true_next',
+        'false_next', 'predicates' (one lead) and 'vector_predicates'
+        (columns, None if the condition doesn't vectorize).
+        """
+        self.node_ids = tuple(node_id for node_id, _ in items)
+        index = dict((node_id, position) for position, node_id in enumerate(self.node_ids))
+        if len(index) != len(items):
+            raise self.Error('duplicated node ids')
+        if start_node not in index:
+            raise self.Error('unknown start node: %s' % start_node)
+
+        self.start = index[start_node]
+        self.is_leaf, self.true_next, self.false_next = [], [], []
+        self.conditions, self.predicates, self.vector_predicates = [], [], []
+        self.leaves, self.features = [], set()
+
+        vector_namespace = None
+        for node_id, node in items:
+            if 'condition' not in node:
+                self.is_leaf.append(True)
+                self.true_next.append(-1)
+                self.false_next.append(-1)
+                self.conditions.append(None)
+                self.predicates.append(None)
+                self.vector_predicates.append(None)
+                self.leaves.append(node)
+                continue
+
+            try:
+                true_next = index[str(node['True'] if 'True' in node else node['true'])]
+                false_next = index[str(node['False'] if 'False' in node else node['false'])]
+            except KeyError as err:
+                raise self.Error('node %s: unknown or missing next node %s' % (node_id, err))
+
+            try:
+                tree, names = _parse(node['condition'])
+            except ValueError as err:
+                raise self.Error('node %s: %s' % (node_id, err))
+
+            label = '<policy node %s>' % node_id
+            try:
+                if vector_namespace is None:
+                    vector_namespace = _vector_namespace()
+                vector_predicate = _compile(tree, _Vectorize(), vector_namespace, label)
+            except (ValueError, ImportError):
+                vector_predicate = None
+
+            self.is_leaf.append(False)
+            self.true_next.append(true_next)
+            self.false_next.append(false_next)
+            self.conditions.append(node['condition'])
+            self.predicates.append(_compile(tree, _Features(), { '__builtins__': {} }, label))
+            self.vector_predicates.append(vector_predicate)
+            self.leaves.append(None)
+            self.features.update(names)
+
+        self.depth = self._check_graph()
+
+    def _check_graph(self):
+        """
+        @return: max nodes in a path from the start node
+        @raise: RiskEngine.Error on cycles
+        """
+        depth = {}
+        visiting = set()
+
+        def visit(position):
+            if position in depth:
+                return depth[position]
+            if position in visiting:
+                raise self.Error('cycle at node %s' % self.node_ids[position])
+            if self.is_leaf[position]:
+                depth[position] = 1
+                return 1
+
+            visiting.add(position)
+            depth[position] = 1 + max(visit(self.true_next[position]),
+                                      visit(self.false_next[position]))
+            visiting.discard(position)
+            return depth[position]
+
+        return visit(self.start)
+
+    # ---- one lead
+
+    def _test(self, position, features):
+
+        try:
+            return bool(self.predicates[position](features))
+        except KeyError as err:
+            raise self.Error('node %s: missing feature %s' % (self.node_ids[position], err))
+        except Exception as err:
+            raise self.Error('node %s: %r failed - %s'
+                             % (self.node_ids[position], self.conditions[position], err))
+
+    def evaluate(self, features):
+        """
+        @param features: feature name -> value
+        @return: { 'decision', 'node': leaf id, 'path': node ids from the
+                   start node to the leaf, 'leaf': the leaf node,
+                   'response_time' }
+        @raise: RiskEngine.Error on missing features or failing conditions
+        """
+        t0 = datetime.now()
+
+        is_leaf, true_next, false_next = self.is_leaf, self.true_next, self.false_next
+        position = self.start
+        path = [position]
+        while not is_leaf[position]:
+            position = true_next[position] if self._test(position, features) else false_next[position]
+            path.append(position)
+
+        t1 = datetime.now()
+
+        leaf = self.leaves[position]
+        return  {
+                    'decision': leaf.get('decision'),
+                    'node': self.node_ids[position],
+                    'path': [self.node_ids[step] for step in path],
+                    'leaf': leaf,
+                    'response_time': t1 - t0
+                }
+
+    # ---- batch
+
+    def _columns(self, features):
+        import numpy as np
+
+        if isinstance(features, dict):
+            missing = self.features - set(features)
+            if missing:
+                raise self.Error('missing feature columns: %s' % sorted(missing))
+            columns = dict((name, np.asarray(features[name])) for name in self.features)
+            sizes = set(len(column) for column in features.values())
+        else:
+            rows = list(features)
+            columns = dict((name, np.array([row.get(name) for row in rows]))
+                           for name in self.features)
+            sizes = set([len(rows)])
+
+        if len(sizes) > 1:
+            raise self.Error('feature columns of different lengths: %s' % sorted(sizes))
+
+        return columns, sizes.pop() if sizes else 0
+
+    def _test_batch(self, position, columns, rows):
+        import numpy as np
+
+        subset = dict((name, column[rows]) for name, column in columns.items())
+
+        predicate = self.vector_predicates[position]
+        if predicate is not None:
+            try:
+                # numpy turns x / 0 into inf / nan where 'evaluate' raises:
+                # make it raise too, so those leads go one at a time
+                with np.errstate(divide='raise', invalid='raise', over='raise'):
+                    result = np.asarray(predicate(subset))
+                return np.broadcast_to(result, rows.shape).astype(bool)
+            except Exception:
+                # e.g. None compared with a number, a division by zero: one
+                # lead at a time, as 'evaluate' does
+                pass
+
+        # python values, not numpy scalars: 1 / np.int64(0) is inf, not an error
+        names = list(subset)
+        values = zip(*(subset[name].tolist() for name in names)) if names else [()] * len(rows)
+        return np.fromiter((self._test(position, dict(zip(names, row))) for row in values),
+                           dtype=bool, count=len(rows))
+
+    def evaluate_batch(self, features):
+        """
+        evaluates every lead at once: each step moves all the leads sitting
+        on the same node with one vectorized predicate call.
+
+        @param features: feature name -> column (list / numpy array), or a
+                         list of feature dicts
+        @return: { 'decision': array, 'node': array of leaf ids,
+                   'path': (leads x max depth) array of node ids, padded
+                   with None, 'response_time' }
+        @raise: RiskEngine.Error where 'evaluate' raises for one of the leads
+        """
+        import numpy as np
+
+        t0 = datetime.now()
+
+        columns, size = self._columns(features)
+        is_leaf = np.array(self.is_leaf, dtype=bool)
+        node_ids = np.array(self.node_ids + (None,), dtype=object)
+
+        current = np.full(size, self.start, dtype=np.int64)
+        steps = np.full((size, self.depth), -1, dtype=np.int64)
+        steps[:, 0] = current
+
+        for step in range(1, self.depth):
+            active = np.flatnonzero(~is_leaf[current])
+            if not len(active):
+                break
+            nodes = current[active]
+            for position in np.unique(nodes):
+                rows = active[nodes == position]
+                passed = self._test_batch(position, columns, rows)
+                current[rows] = np.where(passed, self.true_next[position], self.false_next[position])
+            steps[active, step] = current[active]
+
+        decisions = np.array([leaf.get('decision') if leaf is not None else None
+                              for leaf in self.leaves], dtype=object)
+
+        t1 = datetime.now()
+
+        return  {
+                    'decision': decisions[current],
+                    'node': node_ids[current],
+                    'path': node_ids[steps],
+                    'response_time': t1 - t0
+                }
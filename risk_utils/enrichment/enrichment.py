@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+enrichment module
+
+runs the blacklist, cendeu and nosis lookups of a lead at the same time and
+merges them into one feature dict.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from ..blacklist.blacklist import Blacklist
+from ..cendeu.cendeu import Cendeu
+from ..nosis.nosis import Nosis
+
+# ----
+
+SOURCES = ('blacklist', 'cendeu', 'nosis')
+
+ENRICHMENT_MAX_WORKERS = int(os.environ.get('ENRICHMENT_MAX_WORKERS', 30))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ENRICHMENT_MAX_WORKERS,
+                                           thread_name_prefix='enrichment')
+    return _executor
+
+# ----
+
+def _source_status(status, response_time=None, error=None):
+
+    return  {
+                'status': status,
+                'response_time': response_time,
+                'error': error
+            }
+
+def _is_blacklisted(status, result):
+    return status['status'] == 'ok' and result['data']['is_in_blacklist']
+
+def _merge(results, statuses, t0, t1):
+
+    data = {}
+    for source in SOURCES:
+        result = results.get(source)
+        if result is not None:
+            data.update(result['data'])
+
+    return  {
+                'data': data,
+                'sources': statuses,
+                'response_time': t1-t0
+            }
+
+def _check_short_circuit(short_circuit):
+
+    unknown = set(short_circuit) - set(SOURCES[1:])
+    if unknown:
+        raise ValueError('short_circuit: unknown sources %s' % sorted(unknown))
+
+def enrich_lead(lead, blacklist=None, cendeu=None, nosis=None, short_circuit=()):
+    """
+    runs 'Blacklist.is_in_blacklist', 'Cendeu.is_in_cendeu' and
+    'Nosis.get_nosis_data' concurrently for 'lead'.
+
+    @param short_circuit: sources ('cendeu', 'nosis') that wait for the
+                          blacklist answer and are skipped when the lead is
+                          blacklisted. if the blacklist lookup fails they
+                          still run.
+
+    @return: { 'data': merged features (is_in_blacklist, cendeu_*, nosis_*),
+               'sources': { source: { 'status': 'ok' | 'error' | 'skipped',
+                                      'response_time', 'error' } },
+               'response_time': total elapsed }
+
+    a failing source never raises, its error is reported in 'sources'.
+    """
+    _check_short_circuit(short_circuit)
+
+    calls = {
+        'blacklist': lambda: (blacklist or Blacklist()).is_in_blacklist(lead, verbose=True),
+        'cendeu': lambda: (cendeu or Cendeu()).is_in_cendeu(lead, verbose=True),
+        'nosis': lambda: (nosis or Nosis()).get_nosis_data(lead)
+    }
+
+    results = {}
+    statuses = {}
+
+    def run(source):
+        try:
+            results[source] = calls[source]()
+            statuses[source] = _source_status('ok', results[source]['response_time'])
+        except Exception as err:
+            statuses[source] = _source_status('error', error=err)
+
+    executor = _get_executor()
+
+    t0 = datetime.now()
+    futures = [executor.submit(run, source) for source in SOURCES
+               if source not in short_circuit]
+
+    if short_circuit:
+        futures[0].result() # blacklist
+        if _is_blacklisted(statuses['blacklist'], results.get('blacklist')):
+            for source in short_circuit:
+                statuses[source] = _source_status('skipped')
+        else:
+            futures.extend(executor.submit(run, source) for source in short_circuit)
+
+    for future in futures:
+        future.result()
+    t1 = datetime.now()
+
+    return _merge(results, statuses, t0, t1)
+
+async def enrich_lead_async(lead, blacklist=None, cendeu=None, nosis=None, short_circuit=()):
+    """
+    asyncio version of 'enrich_lead', same parameters and result.
+    """
+    _check_short_circuit(short_circuit)
+
+    calls = {
+        'blacklist': lambda: (blacklist or Blacklist()).is_in_blacklist_async(lead, verbose=True),
+        'cendeu': lambda: (cendeu or Cendeu()).is_in_cendeu_async(lead, verbose=True),
+        'nosis': lambda: (nosis or Nosis()).get_nosis_data_async(lead)
+    }
+
+    results = {}
+    statuses = {}
+
+    async def run(source):
+        try:
+            results[source] = await calls[source]()
+            statuses[source] = _source_status('ok', results[source]['response_time'])
+        except Exception as err:
+            statuses[source] = _source_status('error', error=err)
+
+    async def run_after_blacklist(source, blacklist_task):
+        await blacklist_task
+        if _is_blacklisted(statuses['blacklist'], results.get('blacklist')):
+            statuses[source] = _source_status('skipped')
+        else:
+            await run(source)
+
+    t0 = datetime.now()
+    blacklist_task = asyncio.ensure_future(run('blacklist'))
+    tasks = [blacklist_task]
+    for source in SOURCES[1:]:
+        if source in short_circuit:
+            tasks.append(run_after_blacklist(source, blacklist_task))
+        else:
+            tasks.append(run(source))
+
+    await asyncio.gather(*tasks)
+    t1 = datetime.now()
+
+    return _merge(results, statuses, t0, t1)
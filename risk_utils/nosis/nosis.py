@@ -6,18 +6,167 @@ nosis module
 import json
 import os
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 from retrying import retry
 # https://pypi.org/project/retrying/
 
-from dotenv import load_dotenv, find_dotenv 
-# https://github.com/theskumar/python-dotenv#installation
+from ..client.session import get_session, get_async_session, \
+                             DEFAULT_POOL_CONNECTIONS, DEFAULT_POOL_MAXSIZE
+from ..client.batch import run_many, DEFAULT_CONCURRENCY
+from ..client.singleflight import SingleFlight
+from ..client.env import load_env
 
 # ----
 
-dotenv_path = find_dotenv() 
-load_dotenv(dotenv_path)
+load_env()
+
+# ---- features
+
+# 'get_nosis_data' features: (feature, raw_data key, cast, default).
+# cast: None (as is), 'flag' (== 1), 'int', 'float' or 'days_since' ('%m/%Y'
+# date to days until today). REQUIRED keys raise KeyError when missing.
+REQUIRED = object()
+
+NOSIS_SCHEMA = (
+    # OK
+    ('nosis_currently_inactive', 'currently_inactive', 'flag', REQUIRED),
+    ('nosis_employer_since_in_days', 'employer_since', 'days_since', REQUIRED),
+    ('nosis_worst_situation_historical', 'worst_situation_historical', None, REQUIRED),
+    ('nosis_socioeconomic_level', 'socioeconomic_level', None, REQUIRED),
+    ('nosis_monotributista', 'monotributista', 'flag', REQUIRED),
+    ('nosis_has_commercial_references', 'commercial_references', 'flag', REQUIRED),
+    ('nosis_region', 'region', None, REQUIRED),
+    ('nosis_has_demand', 'has_demand', 'flag', REQUIRED),
+    ('nosis_age', 'age', 'int', REQUIRED),
+    ('nosis_score', 'score', 'int', REQUIRED),
+    ('nosis_query_count', 'query_count', 'int', REQUIRED),
+    ('nosis_monthly_commitments', 'monthly_commitments', 'float', REQUIRED),
+    ('nosis_rejected_checks', 'rejected_checks', 'flag', False),
+    ('nosis_is_dead', 'is_dead', 'flag', 0),
+    ('nosis_currently_working', 'currently_working', 'flag', 0),
+    ('nosis_retired', 'retired', 'flag', 0),
+    ('nosis_employer_fullname', 'employer_fullname', None, None),
+    ('nosis_credit_history_in_months', 'credit_history', 'int', 0), # FIXME: cast
+
+    # new features
+    ('nosis_worst_situation', 'worst_situation', None, REQUIRED),
+    ('nosis_current_situation', 'current_situation', None, REQUIRED),
+)
+
+# columnar dtype and value used for leads without nosis data
+_CAST_COLUMNS = {
+    None: ('object', None),
+    'flag': ('bool', False),
+    'int': ('int64', -999),
+    'float': ('float64', float('nan')),
+    'days_since': ('int64', -999)
+}
+
+@lru_cache(maxsize=4096)
+def _parse_month_year(value):
+
+    try:
+        return datetime.strptime(value, '%m/%Y').date()
+    except ValueError:
+        return None
+
+def _days_since(value, today):
+
+    if value is None:
+        return -999
+
+    since = _parse_month_year(value)
+    if since is None:
+        return -1
+    return (today - since).days
+
+def _field_expression(key, cast, default):
+
+    if default is REQUIRED:
+        value = 'raw_data[%r]' % key
+    else:
+        value = 'raw_data.get(%r, %r)' % (key, default)
+
+    if cast is None:
+        return value
+    if cast == 'flag':
+        return '%s == 1' % value
+    if cast in ('int', 'float'):
+        return '%s(%s)' % (cast, value)
+    if cast == 'days_since':
+        return '_days_since(%s, today)' % value
+    raise ValueError('unknown cast: %s' % cast)
+
+def compile_schema(schema):
+    """
+    compiles a features schema into python functions, once:
+
+        extract(raw_data, today) -> data dict with 'is_in_nosis': True
+        getters[feature](raw_data, today) -> value of a single feature
+    """
+    namespace = { '_days_since': _days_since }
+
+    lines = ['def extract(raw_data, today):',
+             '    return {',
+             "        'is_in_nosis': True,"]
+    for feature, key, cast, default in schema:
+        lines.append('        %r: %s,' % (feature, _field_expression(key, cast, default)))
+    lines.append('    }')
+
+    for feature, key, cast, default in schema:
+        lines.append('def get_%s(raw_data, today):' % feature)
+        lines.append('    return %s' % _field_expression(key, cast, default))
+
+    exec('\n'.join(lines), namespace)
+
+    getters = dict((feature, namespace['get_%s' % feature]) for feature, _, _, _ in schema)
+    return namespace['extract'], getters
+
+_extract, _getters = compile_schema(NOSIS_SCHEMA)
+
+def extract_nosis_features(raw_data, today=None):
+    """
+    'get_nosis_data' features of a non empty nosis 'raw_data'.
+    """
+    return _extract(raw_data, today or datetime.now().date())
+
+def extract_nosis_features_batch(raw_datas, today=None):
+    """
+    columnar version of 'extract_nosis_features' for stored nosis payloads.
+
+    @param raw_datas: iterable of nosis 'raw_data' dicts (empty or None
+                      when the lead was not in nosis)
+    @return: { feature: numpy array } aligned with 'raw_datas', including
+             'is_in_nosis'. leads without data get False for flags, -999
+             for ints, nan for floats and None otherwise.
+    """
+    import numpy as np
+
+    raw_datas = raw_datas if isinstance(raw_datas, list) else list(raw_datas)
+    today = today or datetime.now().date()
+    count = len(raw_datas)
+
+    columns = {
+        'is_in_nosis': np.fromiter((bool(raw_data) for raw_data in raw_datas),
+                                   dtype='bool', count=count)
+    }
+
+    for feature, _, cast, _ in NOSIS_SCHEMA:
+        dtype, missing = _CAST_COLUMNS[cast]
+        getter = _getters[feature]
+        values = (getter(raw_data, today) if raw_data else missing for raw_data in raw_datas)
+
+        if dtype == 'object':
+            column = np.empty(count, dtype='object')
+            for index, value in enumerate(values):
+                column[index] = value
+            columns[feature] = column
+        else:
+            columns[feature] = np.fromiter(values, dtype=dtype, count=count)
+
+    return columns
 
 # ----
 
@@ -25,40 +174,143 @@ class Nosis(object):
 
     API_NOSIS_URL = os.environ.get('API_NOSIS_URL')
 
+    # 'get_nosis_data' cache ttl in seconds
+    CACHE_TTL = int(os.environ.get('API_NOSIS_CACHE_TTL', 3 * 24 * 3600))
+    CACHE_NEGATIVE_TTL = int(os.environ.get('API_NOSIS_CACHE_NEGATIVE_TTL', 24 * 3600))
+
+    # in-flight lookups, shared by every instance in the process
+    _flight = SingleFlight()
+
     class Error(Exception):
         pass
 
-    def is_in_nosis(self, lead, verbose=False):
-        
-        # query string params
-        qs_params = (   
-                        self.API_NOSIS_URL,
-                        lead.get('identification_number', ''),
-                        lead.get('fullname', ''),
-                        lead.get('sources', '')
-                    )
-        
-        # url formation
-        url =  ('%s/person?identification_number=%s&'
-                          'fullname=%s&'
-                          'sources=%s') % qs_params
-        
+    def __init__(self,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 pool_block=False,
+                 keep_alive=True,
+                 cache=None):
+        # pooled keep-alive session, shared by every instance in the process
+        self.session_options = {
+            'pool_connections': pool_connections,
+            'pool_maxsize': pool_maxsize,
+            'pool_block': pool_block,
+            'keep_alive': keep_alive
+        }
+        # optional response cache ('client.cache.LRUCache' or 'DiskCache')
+        self.cache = cache
+
+    @property
+    def session(self):
+        return get_session('nosis', **self.session_options)
+
+    @property
+    def async_session(self):
+        return get_async_session('nosis', **self.session_options)
+
+    def _send(self, url):
+
         # send request
         try:
             t0 = datetime.now()
-            response = requests.get(url)
+            response = self.session.get(url)
             t1 = datetime.now()
         except requests.ConnectionError as err:
-            error_message = { 
+            error_message = {
                                 'error_code': 0,
                                 'error_message': err
                             }
             raise self.Error(error_message)
 
+        return response.status_code, response.text, t1-t0
+
+    async def _send_async(self, url):
+        import aiohttp
+
+        # send request
+        try:
+            t0 = datetime.now()
+            async with self.async_session.get(url) as response:
+                status_code = response.status
+                text = await response.text()
+            t1 = datetime.now()
+        except aiohttp.ClientConnectionError as err:
+            error_message = {
+                                'error_code': 0,
+                                'error_message': err
+                            }
+            raise self.Error(error_message)
+
+        return status_code, text, t1-t0
+
+    # ---- cache
+
+    def _cache_key(self, lead):
+        return 'nosis:%s' % lead.get('identification_number')
+
+    def _cache_set(self, key, result):
+
+        # only the payload is cached: features such as
+        # 'nosis_employer_since_in_days' depend on today, they are extracted
+        # again on every read
+        raw_data = result.get('raw_data')
+        entry = {
+                    'raw_data': raw_data,
+                    'response_time': result['response_time'].total_seconds()
+                }
+        if raw_data:
+            self.cache.set(key, entry, self.CACHE_TTL)
+        else:
+            self.cache.set(key, entry, self.CACHE_NEGATIVE_TTL)
+
+    def _cached_result(self, entry):
+        return self._nosis_data_result(entry['raw_data'], timedelta(seconds=entry['response_time']))
+
+    # ---- is_in_nosis
+
+    def _is_in_nosis_url(self, lead):
+
+        # query string params
+        qs_params = (
+                        self.API_NOSIS_URL,
+                        lead.get('identification_number', ''),
+                        lead.get('fullname', ''),
+                        lead.get('sources', '')
+                    )
+
+        # url formation
+        return ('%s/person?identification_number=%s&'
+                          'fullname=%s&'
+                          'sources=%s') % qs_params
+
+    def _fetch_is_in_nosis(self, url, verbose):
+
+        status_code, text, response_time = self._send(url)
+        return self._is_in_nosis_response(status_code, text, response_time, verbose)
+
+    async def _fetch_is_in_nosis_async(self, url, verbose):
+
+        status_code, text, response_time = await self._send_async(url)
+        return self._is_in_nosis_response(status_code, text, response_time, verbose)
+
+    def is_in_nosis(self, lead, verbose=False):
+
+        # concurrent calls for the same lead share one request
+        url = self._is_in_nosis_url(lead)
+        return self._flight.do((url, verbose), lambda: self._fetch_is_in_nosis(url, verbose))
+
+    async def is_in_nosis_async(self, lead, verbose=False):
+
+        url = self._is_in_nosis_url(lead)
+        return await self._flight.do_async((url, verbose),
+                                           lambda: self._fetch_is_in_nosis_async(url, verbose))
+
+    def _is_in_nosis_response(self, status_code, text, response_time, verbose):
+
         # handle ok response
-        if response.status_code == 200:
+        if status_code == 200:
 
-            raw_data = json.loads(response.text).get('data', [])
+            raw_data = json.loads(text).get('data', [])
             if raw_data:
 
                 if not verbose:
@@ -67,7 +319,7 @@ class Nosis(object):
                     return  {
                                 'data': { 'is_in_nosis': True },
                                 'raw_data': raw_data,
-                                'response_time': t1-t0
+                                'response_time': response_time
                             }
             else:
                 if not verbose:
@@ -75,129 +327,139 @@ class Nosis(object):
                 else:
                     return  {
                                 'data': { 'is_in_nosis': False },
-                                'response_time': t1-t0
+                                'response_time': response_time
                             }
-        
+
         # handle not ok response
-        elif response.status_code == 203:
+        elif status_code == 203:
 
             if not verbose:
                     return False
             else:
                 return  {
                             'data': { 'is_in_nosis': False },
-                            'response_time': t1-t0
+                            'response_time': response_time
                         }
-        
+
         # handle error response
         else:
 
-            error_message = { 
-                                'error_code': response.status_code,
-                                'error_message': response.text
+            error_message = {
+                                'error_code': status_code,
+                                'error_message': text
                             }
             raise self.Error(error_message)
 
-    @retry(stop_max_attempt_number=1)
-    def get_nosis_data(self, lead):
-        
+    # ---- get_nosis_data
+
+    def _get_nosis_data_url(self, lead):
+
         # query string params
-        qs_params = (   
+        qs_params = (
                         self.API_NOSIS_URL,
                         lead.get('identification_number'),
                         lead.get('fullname', ''),
                         lead.get('sources', 'true')
                     )
         # url formation
-        url = ('%s/lead?identification_number=%s&'
+        return ('%s/lead?identification_number=%s&'
                        'fullname=%s&'
                        'sources=%s') % qs_params
-        # send request
-        try:
-            t0 = datetime.now()
-            response = requests.get(url)
-            t1 = datetime.now()
-        except requests.ConnectionError as err:
-            error_message = { 
-                                'error_code': 0,
-                                'error_message': err
-                            }
-            raise self.Error(error_message)
-        
-        # handle ok response
-        if response.status_code == 200:
 
-            # get 'raw_data'
-            raw_data = json.loads(response.text)['data']['financialData']['nosis']
-            if raw_data:
-            
-                # get 'nosis_employer_since_in_days'
-                try:
-                    if raw_data['employer_since'] is not None:
-                        employer_since_date = datetime.strptime(raw_data['employer_since'], '%m/%Y').date()
-                        today_date = datetime.now().date()
-                        nosis_employer_since_in_days = (today_date - employer_since_date).days
-                    else:
-                        nosis_employer_since_in_days = -999
-                except ValueError:
-                    nosis_employer_since_in_days = -1
-                
-                # set 'data'
-                data =  {
-                            # OK
-                            'is_in_nosis': True,
-                            'nosis_currently_inactive': True if raw_data['currently_inactive'] == 1 else False,
-                            'nosis_employer_since_in_days': nosis_employer_since_in_days,
-                            'nosis_worst_situation_historical': raw_data['worst_situation_historical'],
-                            'nosis_socioeconomic_level': raw_data['socioeconomic_level'],
-                            'nosis_monotributista': True if raw_data['monotributista'] == 1 else False,
-                            'nosis_has_commercial_references': True if raw_data['commercial_references'] == 1 else False,
-                            'nosis_region': raw_data['region'],
-                            'nosis_has_demand': True if raw_data['has_demand'] == 1 else False,
-                            'nosis_age': int(raw_data['age']),
-                            'nosis_score': int(raw_data['score']),
-                            'nosis_query_count': int(raw_data['query_count']),
-                            'nosis_monthly_commitments': float(raw_data['monthly_commitments']),
-                            'nosis_rejected_checks': True if raw_data.get('rejected_checks', False) == 1 else False,
-                            'nosis_is_dead': True if raw_data.get('is_dead', 0) == 1 else False,
-                            'nosis_currently_working': True if raw_data.get('currently_working', 0) == 1 else False,
-                            'nosis_retired': True if raw_data.get('retired', 0) == 1 else False,
-                            'nosis_employer_fullname': raw_data.get('employer_fullname', None),
-                            'nosis_region': raw_data.get('region', None),
-                            'nosis_credit_history_in_months': int(raw_data.get('credit_history', 0)), # FIXME: cast
-                            
-                            # new features
-                            'nosis_worst_situation': raw_data['worst_situation'],
-                            'nosis_current_situation': raw_data['current_situation'],
+    def _fetch_nosis_data(self, url, cache_key):
 
-                        }
-                
-                return  {
-                            'data': data,
-                            'raw_data': raw_data,
-                            'response_time': t1-t0
-                        }
-            
-            else:
+        status_code, text, response_time = self._send(url)
+        result = self._get_nosis_data_response(status_code, text, response_time)
+        if cache_key is not None:
+            self._cache_set(cache_key, result)
+        return result
 
-                return  {
-                            'data': { 'is_in_nosis': False },
-                            'response_time': t1-t0
-                        }
+    async def _fetch_nosis_data_async(self, url, cache_key):
+
+        status_code, text, response_time = await self._send_async(url)
+        result = self._get_nosis_data_response(status_code, text, response_time)
+        if cache_key is not None:
+            self._cache_set(cache_key, result)
+        return result
+
+    @retry(stop_max_attempt_number=1)
+    def get_nosis_data(self, lead):
+
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(lead)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return self._cached_result(entry)
+
+        # concurrent calls for the same lead share one request
+        url = self._get_nosis_data_url(lead)
+        return self._flight.do(url, lambda: self._fetch_nosis_data(url, key))
+
+    async def get_nosis_data_async(self, lead):
+
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(lead)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return self._cached_result(entry)
+
+        url = self._get_nosis_data_url(lead)
+        return await self._flight.do_async(url, lambda: self._fetch_nosis_data_async(url, key))
+
+    def get_nosis_data_many(self, leads, concurrency=DEFAULT_CONCURRENCY):
+        """
+        runs 'get_nosis_data' over an iterable of leads with at most
+        'concurrency' requests in flight and yields, as each one finishes,
+        { 'index', 'result', 'error' } (see 'client.batch.run_many').
+
+        keep 'pool_maxsize' >= 'concurrency' so every request reuses a
+        pooled connection.
+        """
+        return run_many(self.get_nosis_data, leads, concurrency)
+
+    def _nosis_data_result(self, raw_data, response_time):
+
+        if raw_data:
+
+            data = extract_nosis_features(raw_data)
+
+            return  {
+                        'data': data,
+                        'raw_data': raw_data,
+                        'response_time': response_time
+                    }
+
+        else:
+
+            return  {
+                        'data': { 'is_in_nosis': False },
+                        'response_time': response_time
+                    }
+
+    def _get_nosis_data_response(self, status_code, text, response_time):
+
+        # handle ok response
+        if status_code == 200:
+
+            # get 'raw_data'
+            raw_data = json.loads(text)['data']['financialData']['nosis']
+            return self._nosis_data_result(raw_data, response_time)
 
         # handle not ok response
-        elif response.status_code == 203:
+        elif status_code == 203:
 
             return  {
                         'data': { 'is_in_nosis': False },
-                        'response_time': t1-t0
+                        'response_time': response_time
                     }
-        
+
         # handle error response
         else:
 
-            error_message = { 
-                                'error_code': response.status_code,
-                                'error_message': response.text
+            error_message = {
+                                'error_code': status_code,
+                                'error_message': text
                             }
             raise self.Error(error_message)
@@ -9,6 +9,7 @@ setup(name='risk_utils',
       packages=['risk_utils'],
       install_requires=[
             'requests',
+            'aiohttp',
             'python-dotenv',
             'mysqlclient',
             'psycopg2-binary',
@@ -17,5 +18,6 @@ setup(name='risk_utils',
             'requests_aws4auth',
             'elasticsearch',
             'dynamodb-json',
-            'retrying'
+            'retrying',
+            'numpy'
             ])
\ No newline at end of file
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+'engine.RiskEngine' tests: 'evaluate_batch' must give the decision and path
+of 'evaluate' for every lead, and fail where it fails.
+
+    python -m pytest tests
+"""
+import random
+
+import pytest
+
+from risk_utils.engine.engine import RiskEngine
+
+np = pytest.importorskip('numpy')
+
+POLICY = {
+    'start_node': '1',
+    'policy': {
+        '1': { 'condition': 'is_in_blacklist', 'True': '90', 'False': '2' },
+        '2': { 'condition': 'bcra_situation_current > 2 or bcra_worst_situation >= 5',
+               'True': '91', 'False': '3' },
+        '3': { 'condition': 'debt > 0 and income / debt > 2', 'True': '4', 'False': '5' },
+        '4': { 'condition': 'region in ("NOA", "NEA") and not age < 25',
+               'True': '92', 'False': '93' },
+        '5': { 'condition': '18 <= age < 70 and score % 7 != 0', 'True': '6', 'False': '94' },
+        '6': { 'condition': 'income // 1000 - debt * 2 >= 10', 'True': '93', 'False': '94' },
+        '90': { 'decision': 'REJECTED_BLACKLIST' },
+        '91': { 'decision': 'REJECTED_BCRA' },
+        '92': { 'decision': 'APPROVED_REGION' },
+        '93': { 'decision': 'APPROVED' },
+        '94': { 'decision': 'REJECTED' }
+    }
+}
+
+FEATURES = ('is_in_blacklist', 'bcra_situation_current', 'bcra_worst_situation',
+            'debt', 'income', 'region', 'age', 'score')
+
+def _lead(rnd):
+    return  {
+                'is_in_blacklist': rnd.random() < 0.05,
+                'bcra_situation_current': rnd.randint(0, 3),
+                'bcra_worst_situation': rnd.randint(0, 5),
+                'debt': rnd.choice([0, 0, 1, 2, 5, 10, 40]),
+                'income': rnd.choice([0, 500, 1000, 25000, 80000]),
+                'region': rnd.choice(['NOA', 'NEA', 'CABA', 'CENTRO']),
+                'age': rnd.randint(16, 80),
+                'score': rnd.randint(0, 999)
+            }
+
+def _columns(leads, names=FEATURES):
+    return dict((name, [lead[name] for lead in leads]) for name in names)
+
+def _expected(engine, leads):
+    results = []
+    for lead in leads:
+        try:
+            results.append(engine.evaluate(lead))
+        except RiskEngine.Error:
+            results.append(None)
+    return results
+
+def _assert_parity(engine, leads, batch):
+
+    for i, (lead, result) in enumerate(zip(leads, _expected(engine, leads))):
+        assert result is not None, 'lead %s fails in evaluate' % i
+        assert batch['decision'][i] == result['decision'], lead
+        assert batch['node'][i] == result['node'], lead
+        path = [node for node in batch['path'][i] if node is not None]
+        assert path == result['path'], lead
+
+def test_batch_matches_evaluate():
+    rnd = random.Random(7)
+    engine = RiskEngine(POLICY)
+
+    # the leads 'evaluate' can't decide are covered by the tests below
+    leads = [_lead(rnd) for _ in range(2000)]
+    leads = [lead for lead, result in zip(leads, _expected(engine, leads)) if result is not None]
+
+    _assert_parity(engine, leads, engine.evaluate_batch(_columns(leads)))
+    _assert_parity(engine, leads, engine.evaluate_batch(leads))
+
+def test_division_by_zero_is_not_inf():
+    # income / debt with debt == 0: inf in numpy, an error in 'evaluate'
+    policy = {
+        'start_node': '1',
+        'policy': {
+            '1': { 'condition': 'income / debt > 2', 'True': '2', 'False': '3' },
+            '2': { 'decision': 'APPROVED' },
+            '3': { 'decision': 'REJECTED' }
+        }
+    }
+    engine = RiskEngine(policy)
+    leads = [{ 'income': 1000, 'debt': 10 }, { 'income': 1000, 'debt': 0 }]
+
+    with pytest.raises(RiskEngine.Error):
+        engine.evaluate(leads[1])
+    with pytest.raises(RiskEngine.Error):
+        engine.evaluate_batch(_columns(leads, ('income', 'debt')))
+
+    result = engine.evaluate_batch(_columns(leads[:1], ('income', 'debt')))
+    assert list(result['decision']) == ['APPROVED']
+
+def test_short_circuit_guards_the_division():
+    engine = RiskEngine(POLICY)
+    lead = dict(_lead(random.Random(1)), is_in_blacklist=False, bcra_situation_current=0,
+                bcra_worst_situation=0, debt=0, income=1000, age=30, score=1)
+
+    result = engine.evaluate(lead)
+    batch = engine.evaluate_batch([lead])
+    assert batch['decision'][0] == result['decision']
+
+def test_none_values_fall_back_to_evaluate():
+    engine = RiskEngine(POLICY)
+    leads = [dict(_lead(random.Random(seed)), is_in_blacklist=False, bcra_situation_current=None,
+                  bcra_worst_situation=1) for seed in range(5)]
+
+    with pytest.raises(RiskEngine.Error):
+        engine.evaluate(leads[0])
+    with pytest.raises(RiskEngine.Error):
+        engine.evaluate_batch(leads)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+'data.cache' tests: table tags of the queries and tag bookkeeping.
+
+    python -m pytest tests
+"""
+import time
+
+from risk_utils.data.cache import QueryCache, query_tags, table_tag
+
+# ---- query_tags
+
+def test_single_table():
+    assert query_tags('SELECT * FROM a WHERE id = 1') == {'a'}
+
+def test_comma_separated_tables():
+    assert query_tags('SELECT * FROM a, b') == {'a', 'b'}
+
+def test_comma_separated_tables_with_aliases():
+    query = 'SELECT x.id FROM t1 x, dbo.[T2] AS y, c WHERE x.id = y.id'
+    assert query_tags(query) == {'t1', 't2', 'c'}
+
+def test_joins():
+    query = ('SELECT * FROM a INNER JOIN b ON a.id = b.id '
+             'LEFT JOIN `s`.`c` USING (id)')
+    assert query_tags(query) == {'a', 'b', 'c'}
+
+def test_alias_is_not_a_clause():
+    assert query_tags('SELECT * FROM a JOIN b ON a.id = b.id') == {'a', 'b'}
+    assert query_tags('SELECT * FROM a GROUP BY x') == {'a'}
+
+def test_subqueries():
+    query = 'SELECT * FROM a WHERE id IN (SELECT id FROM c, d)'
+    assert query_tags(query) == {'a', 'c', 'd'}
+
+def test_from_inside_functions_is_skipped():
+    query = ("SELECT extract(year FROM created_at), trim(' ' FROM name), "
+             "substring(code FROM 1 FOR 2) FROM entidades")
+    assert query_tags(query) == {'entidades'}
+
+def test_writes():
+    assert query_tags('INSERT INTO z SELECT * FROM w') == {'z', 'w'}
+    assert query_tags('UPDATE u SET x = 1') == {'u'}
+
+def test_case_and_quoting():
+    assert query_tags('select * from "Public"."Leads"') == {'leads'}
+    assert table_tag('dbo.[Entidades]') == table_tag('entidades')
+
+# ---- QueryCache
+
+def test_invalidate_by_any_table_of_the_query():
+    cache = QueryCache()
+    cache.set('key', [1], tags=query_tags('SELECT * FROM a, b'))
+
+    assert cache.invalidate('b') == 1
+    assert cache.get('key') is None
+
+def test_get_of_expired_key_untags():
+    cache = QueryCache()
+    cache.set('key', [1], ttl=0.01, tags={'a'})
+    time.sleep(0.02)
+
+    assert cache.get('key') is None
+    assert cache._tags == {}
+    assert cache._key_tags == {}
+
+def test_delete_untags():
+    cache = QueryCache()
+    cache.set('key', [1], tags={'a'})
+    cache.delete('key')
+
+    assert cache._tags == {}
+    assert cache._key_tags == {}
+
+def test_eviction_untags():
+    cache = QueryCache(maxsize=1)
+    cache.set('first', [1], tags={'a'})
+    cache.set('second', [2], tags={'b'})
+
+    assert cache.get('first') is None
+    assert set(cache._tags) == {'b'}